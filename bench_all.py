@@ -0,0 +1,356 @@
+'''
+Benchmarks for dictabase against a local SQLite file, run with:
+
+    python bench_all.py                                     # a quick run
+    python bench_all.py --full                              # 1k/100k/1M rows and 10/1k/10k live objects
+    python bench_all.py --rows 100000 --live 1000 --threads 1,4 --json new.json
+    python bench_all.py --json new.json --compare old.json  # flag anything slower than old.json
+
+Every result is in operations per second, higher is better. What an operation is depends on the benchmark,
+for example one New() call, or one row streamed by FindAll().
+With --compare the exit code is 1 if any result is more than --threshold slower than the same result in the
+other file, so it can be used to catch regressions between versions.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import importlib.util
+import platform
+import tempfile
+import subprocess
+from threading import Thread
+import dictabase
+from dictabase import RegisterDBURI, BaseTable, New, NewMany, FindOne, FindAll, Delete, Drop, Flush
+
+
+class BenchRow(BaseTable):
+    pass
+
+
+MAX_OPS = 1000  # operations per benchmark, so the large tables dont make every benchmark take minutes
+
+
+def Setup(numRows, numLive):
+    '''
+    Fills a new table with numRows rows, and keeps the first numLive of them in use.
+
+    :return: dict like {'ids': [int], 'live': [BenchRow], 'numRows': int}
+    '''
+    Drop(BenchRow, confirm=True)
+    ids = NewMany(BenchRow, (dict(count=i, name='name{}'.format(i)) for i in range(numRows)), chunk_size=10000)
+    live = list(FindAll(BenchRow, _limit=numLive, _orderBy='id')) if numLive else []
+    return {'ids': ids, 'live': live, 'numRows': numRows}
+
+
+def RunThreads(work, numOps, numThreads):
+    '''
+    Calls work(i) for i in range(numOps), shared out over numThreads threads.
+
+    :return: float - seconds it took
+    '''
+    def Worker(first):
+        for i in range(first, numOps, numThreads):
+            work(i)
+
+    threads = [Thread(target=Worker, args=(first,)) for first in range(numThreads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def BenchNew(state, numThreads):
+    # one New() per operation, every New() is its own transaction
+    numOps = MAX_OPS
+    seconds = RunThreads(lambda i: New(BenchRow, count=-1, name='new'), numOps, numThreads)
+    dictabase.DeleteWhere(BenchRow, count=-1)
+    return numOps, seconds
+
+
+def BenchFindOneHit(state, numThreads):
+    # the obj is in use, so the db is not queried
+    live = state['live']
+    if not live:
+        return None
+    liveIDs = [obj['id'] for obj in live]
+    FindOne(BenchRow, id=liveIDs[0])  # the first search by 'id' builds the in-use index, dont time that
+    numOps = MAX_OPS
+    return numOps, RunThreads(lambda i: FindOne(BenchRow, id=liveIDs[i % len(liveIDs)]), numOps, numThreads)
+
+
+def BenchFindOneMiss(state, numThreads):
+    # the obj is not in use, so it is read from the db
+    ids = state['ids'][len(state['live']):]
+    numOps = min(MAX_OPS, len(ids))
+    if numOps == 0:
+        return None
+    # without the cache the objs found are dropped again right away, so every run reads them from the db
+    dictabase.SetCacheSize(0)
+    try:
+        return numOps, RunThreads(lambda i: FindOne(BenchRow, id=ids[i]), numOps, numThreads)
+    finally:
+        dictabase.SetCacheSize(1000)
+
+
+def WithDebug(bench):
+    '''
+    Runs bench with SetDebug(True), to compare with the same benchmark with debug off.
+    The messages are formatted and written to os.devnull instead of being printed.
+    '''
+    def BenchDebug(state, numThreads):
+        parentLog = logging.getLogger('dictabase')
+        handler = logging.StreamHandler(open(os.devnull, 'w'))
+        parentLog.addHandler(handler)  # SetDebug() does not add its own handler when there is one
+        parentLog.propagate = False
+        dictabase.SetDebug(True)
+        try:
+            return bench(state, numThreads)
+        finally:
+            dictabase.SetDebug(False)
+            parentLog.propagate = True
+            parentLog.removeHandler(handler)
+            handler.stream.close()
+
+    return BenchDebug
+
+
+def BenchFindAll(state, numThreads):
+    # streams the whole table, one operation is one row
+    def Scan(i):
+        for _ in FindAll(BenchRow, _detached=True):
+            pass
+
+    return state['numRows'] * numThreads, RunThreads(Scan, numThreads, numThreads)
+
+
+def BenchFindAllReadonly(state, numThreads):
+    # same as FindAll, with read-only rows instead of objs
+    def Scan(i):
+        for _ in FindAll(BenchRow, _readonly=True):
+            pass
+
+    return state['numRows'] * numThreads, RunThreads(Scan, numThreads, numThreads)
+
+
+def BenchFindAllColumns(state, numThreads):
+    # reads two columns of the whole table into numpy arrays, one operation is one row
+    if importlib.util.find_spec('numpy') is None:
+        return None
+
+    def Scan(i):
+        dictabase.FindAllColumns(BenchRow, ['count', 'name'], _dtypes={'count': 'i8'})
+
+    return state['numRows'] * numThreads, RunThreads(Scan, numThreads, numThreads)
+
+
+def BenchFindAllWhileWriting(state, numThreads):
+    # same as FindAll with one thread, while another thread keeps inserting rows
+    done = []
+
+    def Writer():
+        while not done:
+            NewMany(BenchRow, (dict(count=-1, name='new') for _ in range(1000)))
+
+    writer = Thread(target=Writer)
+    writer.start()
+    try:
+        ret = BenchFindAll(state, 1)
+    finally:
+        done.append(True)
+        writer.join()
+    dictabase.DeleteWhere(BenchRow, count=-1)
+    return ret
+
+
+def BenchWriteBack(state, numThreads):
+    # changes every live obj and writes the changes, one operation is one changed obj
+    live = state['live']
+    if not live:
+        return None
+    start = time.perf_counter()
+    for obj in live:
+        obj['count'] += 1
+    Flush(BenchRow)
+    return len(live), time.perf_counter() - start
+
+
+def BenchDelete(state, numThreads):
+    # deletes rows that are not in use
+    ids = state['ids'][len(state['live']):]
+    numOps = min(MAX_OPS, len(ids))
+    if numOps == 0:
+        return None
+    objs = [FindOne(BenchRow, id=ID) for ID in ids[:numOps]]
+    start = time.perf_counter()
+    for obj in objs:
+        Delete(obj)
+    return numOps, time.perf_counter() - start
+
+
+def BenchDrop(state, numThreads):
+    # one operation is dropping the whole table
+    state['live'] = []
+    start = time.perf_counter()
+    Drop(BenchRow, confirm=True)
+    return 1, time.perf_counter() - start
+
+
+# (name, function, can use several threads), in the order they are run on the same table
+BENCHMARKS = [
+    ('New', BenchNew, True),
+    ('NewDebug', WithDebug(BenchNew), True),
+    ('FindOneHit', BenchFindOneHit, True),
+    ('FindOneMiss', BenchFindOneMiss, True),
+    ('FindOneMissDebug', WithDebug(BenchFindOneMiss), True),
+    ('FindAll', BenchFindAll, True),
+    ('FindAllReadonly', BenchFindAllReadonly, True),
+    ('FindAllColumns', BenchFindAllColumns, True),
+    ('FindAllWhileWriting', BenchFindAllWhileWriting, False),
+    ('WriteBack', BenchWriteBack, False),
+    ('Delete', BenchDelete, False),
+    ('Drop', BenchDrop, False),
+]
+
+
+def RunAll(rowCounts, liveCounts, threadCounts, only=None):
+    '''
+    :return: list of dicts like {'name': str, 'rows': int, 'live': int, 'threads': int, 'ops': int,
+        'seconds': float, 'opsPerSecond': float}
+    '''
+    results = []
+    for numRows in rowCounts:
+        for numLive in liveCounts:
+            if numLive > numRows:
+                continue
+
+            state = Setup(numRows, numLive)
+            for name, bench, threaded in BENCHMARKS:
+                if only and name not in only:
+                    continue
+
+                for numThreads in threadCounts if threaded else [1]:
+                    ret = bench(state, numThreads)
+                    if ret is None:
+                        continue  # does not apply, for example FindOneHit without live objs
+
+                    ops, seconds = ret
+                    result = {
+                        'name': name,
+                        'rows': numRows,
+                        'live': numLive,
+                        'threads': numThreads,
+                        'ops': ops,
+                        'seconds': seconds,
+                        'opsPerSecond': ops / seconds if seconds else float('inf'),
+                    }
+                    results.append(result)
+                    print('{name:<20} rows={rows:<8} live={live:<6} threads={threads:<2} '
+                          '{opsPerSecond:12.1f} ops/s'.format(**result))
+                    sys.stdout.flush()
+            state = None
+    return results
+
+
+def _ResultKey(result):
+    return result['name'], result['rows'], result['live'], result['threads']
+
+
+def Compare(results, baseline, threshold):
+    '''
+    Prints how much faster or slower each result is than the same result in baseline.
+
+    :param threshold: float - a result this much slower is a regression, 0.1 means 10% fewer ops/s
+    :return: list of the results that regressed
+    '''
+    old = {_ResultKey(result): result for result in baseline['results']}
+    regressions = []
+    print()
+    print('compared with {}'.format(baseline.get('commit') or baseline.get('date')))
+    for result in results:
+        before = old.get(_ResultKey(result))
+        if before is None:
+            continue
+
+        ratio = result['opsPerSecond'] / before['opsPerSecond'] if before['opsPerSecond'] else float('inf')
+        regressed = ratio < 1 - threshold
+        if regressed:
+            regressions.append(result)
+        print('{:<20} rows={:<8} live={:<6} threads={:<2} x{:.2f}{}'.format(
+            *_ResultKey(result), ratio, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def _Commit():
+    # the git commit of this checkout, if there is one
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _Ints(text):
+    return [int(x) for x in text.split(',')]
+
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for dictabase')
+    parser.add_argument('--rows', type=_Ints, default=[1000], help='comma separated numbers of rows in the table')
+    parser.add_argument('--live', type=_Ints, default=[10, 1000], help='comma separated numbers of objects in use')
+    parser.add_argument('--threads', type=_Ints, default=[1, 4], help='comma separated numbers of threads')
+    parser.add_argument('--full', action='store_true', help='1k/100k/1M rows with 10/1k/10k live objects')
+    parser.add_argument('--only', help='comma separated names of the benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=1, help='run everything this many times and keep the best')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with the results in this file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    if args.full:
+        args.rows = [1000, 100000, 1000000]
+        args.live = [10, 1000, 10000]
+
+    dictabase.SetDebug(False)
+    tempDir = tempfile.mkdtemp()
+    try:
+        RegisterDBURI('sqlite:///' + os.path.join(tempDir, 'bench.db'))
+        best = {}
+        for _ in range(args.repeat):
+            for result in RunAll(args.rows, args.live, args.threads, only=args.only.split(',') if args.only else None):
+                key = _ResultKey(result)
+                if key not in best or result['opsPerSecond'] > best[key]['opsPerSecond']:
+                    best[key] = result
+        results = list(best.values())
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
+
+    output = {
+        'commit': _Commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(output, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if Compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
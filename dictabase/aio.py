@@ -0,0 +1,128 @@
+'''
+asyncio front end for dictabase, the blocking calls run in a thread pool so they dont stall the event loop.
+
+    from dictabase import aio
+
+    user = await aio.New(UserClass, name='Grant')
+    user = await aio.FindOne(UserClass, name='Grant')
+    async for user in aio.FindAll(UserClass, _orderBy='age'):
+        ...
+
+The objects are the same in-use objects the blocking API returns, so await aio.FindOne() and FindOne() find the same obj.
+'''
+import asyncio
+import functools
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import dictabase
+from dictabase.helpers import apiLog
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='dictabase')
+
+
+def SetMaxWorkers(maxWorkers):
+    '''
+    Sets how many dictabase calls can run at the same time, the rest wait their turn.
+    FindAll() iterations dont use these workers, each one has a thread of its own.
+
+    :param maxWorkers: int
+    '''
+    global _executor
+    apiLog.debug('aio.SetMaxWorkers(%s)', maxWorkers)
+    oldExecutor = _executor
+    _executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='dictabase')
+    oldExecutor.shutdown(wait=False)
+
+
+async def _Run(func, *args, **kwargs):
+    # if the awaiting task is cancelled before func has started, func is never run
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def New(cls, **kwargs):
+    return await _Run(dictabase.New, cls, **kwargs)
+
+
+async def NewMany(cls, rows, chunk_size=1000, keepInUse=False):
+    return await _Run(dictabase.NewMany, cls, rows, chunk_size=chunk_size, keepInUse=keepInUse)
+
+
+async def FindOne(cls, **kwargs):
+    return await _Run(dictabase.FindOne, cls, **kwargs)
+
+
+async def Delete(obj):
+    return await _Run(dictabase.Delete, obj)
+
+
+async def Drop(cls, confirm=False):
+    return await _Run(dictabase.Drop, cls, confirm=confirm)
+
+
+async def Flush(cls=None):
+    return await _Run(dictabase.Flush, cls)
+
+
+async def FindAll(cls, **kwargs):
+    '''
+    Takes the same kwargs as dictabase.FindAll().
+    The rows are fetched _batchSize at a time by a thread of its own, which keeps its db cursor open in between.
+    It is not one of the shared workers, so awaiting other calls inside the loop cant wait for a worker that never frees up.
+    Stopping the iteration early (break, or the task being cancelled) closes the cursor.
+    '''
+    apiLog.debug('aio.FindAll(%s, %s)', cls, kwargs)
+    loop = asyncio.get_running_loop()
+    batchSize = kwargs.get('_batchSize', 1000)
+    requests = queue.Queue()  # asyncio.Future for the next batch, or None to stop
+
+    threading.Thread(
+        target=_FetchBatches,
+        args=(loop, requests, cls, kwargs, batchSize),
+        name='dictabase-findall',
+        daemon=True,
+    ).start()
+    try:
+        while True:
+            future = loop.create_future()
+            requests.put(future)
+            batch = await future
+            if not batch:
+                return
+
+            for obj in batch:
+                yield obj
+    finally:
+        requests.put(None)
+
+
+def _FetchBatches(loop, requests, cls, kwargs, batchSize):
+    # runs in its own thread, the cursor of a FindAll() must always be used by the thread that opened it
+    found = dictabase.FindAll(cls, **kwargs)
+    try:
+        while True:
+            future = requests.get()
+            if future is None:
+                return
+
+            try:
+                batch = list(itertools.islice(found, batchSize))
+            except BaseException as e:
+                loop.call_soon_threadsafe(_SetResult, future, None, e)
+                return
+
+            loop.call_soon_threadsafe(_SetResult, future, batch, None)
+            if not batch:
+                return
+    finally:
+        found.close()
+
+
+def _SetResult(future, result, exception):
+    if future.done():
+        return  # the task waiting for it was cancelled
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
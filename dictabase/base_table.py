@@ -1,29 +1,54 @@
-from collections import defaultdict
+import time
+import copyreg
+import threading
+from dictabase.helpers import IsMutable, ShallowCopy, cacheLog
+from dictabase.metrics import metrics
 
-global db
-db = None
-
-
-def RegisterDbWorker(newDB):
-    global db
-    db = newDB
+global DEBUG
+DEBUG = False
 
+# keeps _MarkDirty() in one thread from adding a key to the set _PopChanges() in another thread has just taken.
+# Re-entrant because the garbage collector can call __del__() while this thread is holding it.
+_dirtyLock = threading.RLock()
 
-global DEBUG
+_RUNTIME_ATTRIBUTES = ('_dirtyKeys', '_dumped', '_rawKeys', '_deleted', '_worker')  # set by __new__(), never pickled
 
 
 def SetDebug(newState):
-    global print
+    # only changes how BaseTable objects are printed, see dictabase.SetDebug() for logging
     global DEBUG
     DEBUG = newState
-    if newState is False:
-        print = lambda *a, **k: None
 
 
 class BaseTable(dict):
+    # The dumped value of a mutable value (list, dict, set) is kept, and DumpKey() is only called again if a
+    # shallow copy of the value shows it has changed in place. Values that hold mutable values themselves
+    # (for example a list of dicts) are never copied, DumpKey() is called for them every time.
+    # Set this to False to call DumpKey() every time for every mutable value.
+    __dumpCache__ = True
+
+    def __new__(cls, *a, **k):
+        obj = super().__new__(cls, *a, **k)
+        obj._dirtyKeys = set()  # keys that have changed since the last time this obj was written to the db
+        obj._dumped = {}  # {key: (dumpedValue, shallowCopy)} for keys holding mutable values, to detect in-place changes
+        obj._rawKeys = set()  # keys still holding the value from the db, LoadKey() has not been called for them yet
+        obj._deleted = False  # set by Delete()/DeleteWhere(), a deleted obj is never written again
+        obj._worker = None  # the DatabaseWorker whose db holds the row of this obj, set when the obj gets its row
+        return obj
+
+    def __reduce__(self):
+        # only the keys and the attributes of subclasses are pickled, not the state that ties this obj to a db.
+        # Like an obj made with cls(**obj), the unpickled obj is not in use and is never written.
+        self._LoadAll()
+        attributes = {key: value for key, value in self.__dict__.items() if key not in _RUNTIME_ATTRIBUTES}
+        return copyreg.__newobj__, (type(self),), (dict(self), attributes)
+
+    def __setstate__(self, state):
+        items, attributes = state
+        dict.update(self, items)
+        self.__dict__.update(attributes)
 
     def LoadKey(self, key, dbValue):
-        print('BaseTable.LoadKey(', key, dbValue)
         # moving data from database to the BaseTable object
         return dbValue
 
@@ -33,7 +58,6 @@ class BaseTable(dict):
         # }.get(key, lambda v: v)(dbValue)
 
     def DumpKey(self, key, value):
-        print('BaseTable.DumpKey(', key, value)
         # moving data from the BaseTable object to the database
         return value
 
@@ -42,9 +66,211 @@ class BaseTable(dict):
         #     'pages': lambda v: json.dumps(v, indent=2, sort_keys=True),
         # }.get(key, lambda v: v)(objValue)
 
+    def __missing__(self, key):
+        return None
+
+    def __getitem__(self, key):
+        if key in self._rawKeys:
+            self._LoadKey(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __iter__(self):
+        # overriding this makes dict(obj) and {**obj} use self[key], so raw db values are loaded first
+        return super().__iter__()
+
+    def items(self):
+        self._LoadAll()
+        return super().items()
+
+    def values(self):
+        self._LoadAll()
+        return super().values()
+
+    def copy(self):
+        self._LoadAll()
+        return super().copy()
+
+    def __eq__(self, other):
+        self._LoadAll()
+        if isinstance(other, BaseTable):
+            other._LoadAll()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        return ret if ret is NotImplemented else not ret
+
+    def _LoadKey(self, key):
+        dbValue = super().__getitem__(key)
+        if metrics.enabled:
+            start = time.perf_counter()
+            value = self.LoadKey(key, dbValue)
+            metrics.AddKeyTime('LoadKey', type(self), 1, time.perf_counter() - start)
+        else:
+            value = self.LoadKey(key, dbValue)
+        super().__setitem__(key, value)
+        self._rawKeys.discard(key)
+
+        if IsMutable(value):
+            self._dumped[key] = (dbValue, ShallowCopy(value) if self.__dumpCache__ else None)
+            if self._worker is not None:
+                self._worker.WatchForChanges(self)
+
+    def _LoadAll(self):
+        for key in list(self._rawKeys):
+            self._LoadKey(key)
+
+    def _MarkRaw(self):
+        '''
+        Call this after the obj has been created from a db row.
+        LoadKey() is only called for each key the first time that key is used.
+        '''
+        self._dirtyKeys.clear()
+        self._dumped.clear()
+        self._rawKeys = set(super().keys())
+        self._rawKeys.discard('id')
+
+    def _SetRaw(self, dumpedObj):
+        '''
+        Call this after keys of this obj have been changed in the db by a query, like UpdateWhere().
+
+        :param dumpedObj: dict of {key: dumpedValue} as it is now stored in the database
+        '''
+        for key, dumpedValue in dumpedObj.items():
+            super().__setitem__(key, dumpedValue)
+            self._rawKeys.add(key)
+            self._dumped.pop(key, None)
+            with _dirtyLock:
+                self._dirtyKeys.discard(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._rawKeys.discard(key)
+        self._MarkDirty(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._rawKeys.discard(key)
+        self._MarkDirty(key)
+
+    def update(self, *a, **k):
+        for key, value in dict(*a, **k).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = super().pop(key)
+        if key in self._rawKeys:
+            self._rawKeys.discard(key)
+            value = self.LoadKey(key, value)
+        self._MarkDirty(key)  # after the key is gone, like __delitem__, so the in-use index drops the old value
+        return value
+
+    def popitem(self):
+        key, value = super().popitem()
+        if key in self._rawKeys:
+            self._rawKeys.discard(key)
+            value = self.LoadKey(key, value)
+        self._MarkDirty(key)
+        return key, value
+
+    def clear(self):
+        keys = list(self.keys())
+        super().clear()
+        self._rawKeys.clear()
+        for key in keys:
+            self._MarkDirty(key)
+
+    def _MarkDirty(self, key):
+        with _dirtyLock:
+            wasClean = len(self._dirtyKeys) == 0
+            self._dirtyKeys.add(key)
+        if self._worker is not None and 'id' in self:
+            if wasClean:
+                self._worker.MarkDirty(self)
+            self._worker.KeyChanged(self, key)
+
+    def _MarkClean(self, dumpedObj):
+        '''
+        Call this after the obj has been written to (or read from) the database.
+
+        :param dumpedObj: dict of {key: dumpedValue} as it is now stored in the database
+        '''
+        self._dirtyKeys.clear()
+        self._RecordDumped(dumpedObj)
+
+    def _RecordDumped(self, dumpedObj):
+        for key, dumpedValue in dumpedObj.items():
+            value = dict.get(self, key)
+            if key in self and IsMutable(value):
+                self._dumped[key] = (dumpedValue, ShallowCopy(value) if self.__dumpCache__ else None)
+            else:
+                self._dumped.pop(key, None)
+
+    def _PopChanges(self):
+        '''
+        Returns the changes that need to be written to the database and marks them as written.
+
+        :return: dict like {key: dumpedValue} containing only the keys that have changed
+        '''
+        with _dirtyLock:
+            dirtyKeys = self._dirtyKeys
+            self._dirtyKeys = set()
+        dirtyKeys.discard('id')
+
+        start = time.perf_counter() if metrics.enabled else None
+        numDumped = 0
+
+        changes = {}
+        for key in dirtyKeys:
+            if key in self:
+                changes[key] = self.DumpKey(key, dict.__getitem__(self, key))
+                numDumped += 1
+            else:
+                changes[key] = None  # this key was removed
+
+        # mutable values (list, dict, etc) can be changed without calling __setitem__
+        for key, (dumpedValue, shallowCopy) in self._dumped.copy().items():
+            if key not in dirtyKeys and key in self:
+                value = dict.__getitem__(self, key)
+                if shallowCopy is not None and shallowCopy == value:
+                    continue  # not changed, the dumped value is still good
+
+                newDumpedValue = self.DumpKey(key, value)
+                numDumped += 1
+                if newDumpedValue != dumpedValue:
+                    changes[key] = newDumpedValue
+                elif shallowCopy is not None:
+                    self._dumped[key] = (dumpedValue, ShallowCopy(value))
+
+        if start is not None and numDumped:
+            metrics.AddKeyTime('DumpKey', type(self), numDumped, time.perf_counter() - start)
+
+        self._RecordDumped(changes)
+        return changes
+
+    def _HasMutableValues(self):
+        return len(self._dumped) > 0
+
     def __del__(self):
-        print(f'{self}.__del__()')
-        db.Upsert(self)
+        cacheLog.debug('%s.__del__()', self)
+        if self._worker is not None:
+            self._worker.Release(self)
 
     def __str__(self):
         '''
@@ -52,7 +278,7 @@ class BaseTable(dict):
         :return: string like '<BaseDictabaseTable: email=me@website.com, name=John>'
         '''
         itemsList = []
-        for k, v, in self.items():
+        for k, v, in dict.items(self):  # dont call LoadKey() just to print this obj, keys not loaded yet show the db value
             if k.startswith('_'):
                 if DEBUG is False:
                     continue  # dont print these
@@ -0,0 +1,41 @@
+try:
+    import numpy
+except ImportError:  # numpy is only needed for FindAllColumns()
+    numpy = None
+
+
+def ToArrays(batches, columns, dtypes=None, structured=False):
+    '''
+    Turns the batches of rows of DatabaseWorker.FindColumns() into NumPy arrays, one batch at a time,
+    so the rows never exist as Python objects all at once.
+
+    :param batches: iterable of lists of tuples
+    :param columns: list of str
+    :param dtypes: dict like {column: numpy dtype}, columns not in it get the dtype NumPy picks for their values
+    :param structured: bool - return one structured array instead of a dict of arrays
+    :return: dict like {column: numpy.ndarray}, or a numpy.ndarray with a field per column
+    '''
+    if numpy is None:
+        raise ImportError('FindAllColumns() needs NumPy, install it with "pip install numpy".')
+
+    dtypes = dtypes or {}
+    parts = {col: [] for col in columns}  # {column: [numpy.ndarray per batch]}
+    for batch in batches:
+        for col, values in zip(columns, zip(*batch)):
+            parts[col].append(numpy.array(values, dtype=dtypes.get(col)))
+
+    arrays = {}
+    for col in columns:
+        if parts[col]:
+            arrays[col] = numpy.concatenate(parts[col]) if len(parts[col]) > 1 else parts[col][0]
+        else:
+            arrays[col] = numpy.array([], dtype=dtypes.get(col, float))
+        parts[col] = None  # free the batches as soon as they are copied
+
+    if not structured:
+        return arrays
+
+    ret = numpy.empty(len(arrays[columns[0]]), dtype=[(col, arrays[col].dtype) for col in columns])
+    for col in columns:
+        ret[col] = arrays[col]
+    return ret
@@ -1,35 +1,172 @@
 import time
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import threading
+import weakref
 import sys
+import atexit
+import itertools
 import dataset
-from dictabase.helpers import LoadKeys, DumpKeys, IsSubset
+from dataset.util import ResultIter
+from sqlalchemy import select, event, func, null, exc, Index, and_, or_
+from dictabase.helpers import LoadKeys, DumpKeys, IsHashable, apiLog, sqlLog, cacheLog
+from dictabase.in_use_index import InUseIndex
+from dictabase.query import Clause, Matcher
+from dictabase.query_cache import QueryCache, FreezeKwargs
+from dictabase.schema import TableSchema
+from dictabase.metrics import metrics, TimedLock
+from dictabase.base_table import BaseTable
+from dictabase.row import Row, RowLayout
+
+
+def _EnableWAL(dbapiConnection, connectionRecord):
+    # with WAL, readers on other connections are not blocked by the writer, and the writer is not blocked by them
+    cursor = dbapiConnection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+
+def _DisableAutoBegin(dbapiConnection, connectionRecord):
+    # pysqlite starts transactions on its own and gets SAVEPOINTs wrong, let sqlalchemy start them instead
+    dbapiConnection.isolation_level = None
+
+
+def _Begin(connection):
+    # IMMEDIATE takes the write lock right away, so a transaction that reads first cant fail with SQLITE_BUSY later
+    connection.execute('BEGIN IMMEDIATE')
+
+
+class _Database(dataset.Database):
+    # dataset.Database.commit() forgets the metadata of every table, which makes other threads reflect the
+    # tables again in the middle of their reads. Only a rollback can leave the metadata out of date.
+
+    def __init__(self, *a, **k):
+        super().__init__(*a, **k)
+        self.schemas = {}  # {tableName: TableSchema()}
+
+    def begin(self):
+        # inside a transaction dataset begins a subtransaction, whose rollback would roll back the whole transaction.
+        # Begin a savepoint instead, so that a failed write only undoes itself.
+        if getattr(self.local, 'tx', None):
+            self.local.tx.append(self.executable.begin_nested())
+        else:
+            super().begin()
+
+    def commit(self):
+        if hasattr(self.local, 'tx') and self.local.tx:
+            self.local.tx.pop().commit()
+
+    def _flush_tables(self):
+        # called after a rollback, which can also undo the columns that were added in the transaction
+        super()._flush_tables()
+        self.schemas.clear()
+
+    def Schema(self, tableName):
+        # call this while holding the DatabaseWorker's _writeLock
+        schema = self.schemas.get(tableName)
+        if schema is None:
+            schema = self.schemas[tableName] = TableSchema(self, tableName)
+        return schema
+
+
+# errors that writing the same row again will raise again, unlike a locked or unreachable db
+_UNWRITABLE_ERRORS = (
+    exc.IntegrityError,
+    exc.DataError,
+    exc.ProgrammingError,
+    exc.InterfaceError,
+    exc.NotSupportedError,
+)
+
+
+class _TransactionLevel:
+    # what one Transaction() level of a thread has done, so that rolling it back can also undo it in memory
+
+    __slots__ = ('touched', 'inserted', 'deleted', 'changed', 'written')
+
+    def __init__(self):
+        self.touched = defaultdict(set)  # {cls: set(id)} of the rows this thread inserted, deleted or updated
+        self.inserted = []  # objs inserted by New()
+        self.deleted = []  # objs deleted by Delete()/DeleteWhere()
+        self.changed = set()  # {(cls, id)} of the objs this thread changed
+        self.written = defaultdict(dict)  # {cls: {id: changes}} written from the queue, some can be other threads'
+
+    def MergeInto(self, outer):
+        # a savepoint was committed, what it did still belongs to the outer level
+        for cls, IDs in self.touched.items():
+            outer.touched[cls].update(IDs)
+        outer.inserted.extend(self.inserted)
+        outer.deleted.extend(self.deleted)
+        outer.changed.update(self.changed)
+        for cls, rows in self.written.items():
+            for ID, changes in rows.items():
+                outer.written[cls].setdefault(ID, {}).update(changes)
 
 
 class DatabaseWorker:
-    # this is the only object/thread that should interact with the database
+    # this is the only object that should interact with the database.
+    # Every thread uses its own connection (see dataset.Database.executable), so reads run in parallel.
+    # Writes are serialized by self._writeLock.
 
     def __init__(self):
         self._dburi = None
         self._db = None
 
-        self._inUse = defaultdict(dict)  # use dict of dicts for fast lookups
-        self._alreadyDeletedQ = defaultdict(dict)
+        # {cls: {id: obj}} of every obj that is referenced somewhere, so FindOne()/FindAll() return the same obj.
+        # The references are weak, when an obj is no longer used its __del__() writes it and it leaves on its own.
+        self._inUse = defaultdict(weakref.WeakValueDictionary)
+        self._inUseIndex = {}  # {cls: InUseIndex()} for looking up in-use objs by value
+        self._dirty = defaultdict(weakref.WeakValueDictionary)  # objects that may have changes which are not in the db yet
 
-        self._workerLock = threading.Lock()
+        # strong references to the most recently used objs, so they stay in use for a while after the caller drops them
+        self._recent = OrderedDict()  # {(cls, id): obj}, least recently used first
+        self._cacheSize = 1000
+        self._cacheStats = {
+            'hits': 0,  # objs found in use instead of in the db
+            'misses': 0,
+            'evictions': 0,  # objs dropped from self._recent to stay within self._cacheSize
+        }
+        self._indexedClasses = set()  # classes whose __indexes__ and __uniqueIndexes__ all exist in the db
+        self._indexRetryAt = {}  # {cls: time.monotonic()} before which reads dont look for missing indexes again
+        self._dumpers = {}  # {cls: obj} used to call DumpKey() on values that are not in an obj, like filters
+        self._queryCaches = {}  # {cls: QueryCache()} for the classes passed to SetQueryCache()
 
-        self._debug = False
+        # write-behind queue, changes are merged per row and written in a single transaction
+        self._pending = defaultdict(dict)  # {cls: {id: {key: dumpedValue}}}
+        self._numPending = 0  # number of rows in self._pending
+        self._pendingSince = None  # time.monotonic() of the oldest change in self._pending
+        self._maxPending = 1000  # flush when this many rows are waiting
+        self._maxAge = 1  # flush when the oldest change has been waiting this many seconds
+        self._exiting = False
+        atexit.register(self._OnExit)
 
-    def SetDebug(self, newState):
-        self._debug = newState
+        # background flusher, see SetFlushPolicy(background=True)
+        self._background = False
+        self._flusherThread = None
+        self._wakeFlusher = threading.Event()
+        self._released = deque()  # objs whose __del__() has been called, waiting for the next Flush()
+        self._flushStats = {
+            'flushes': 0,  # number of transactions written by _WritePending()
+            'rowsWritten': 0,
+            'lastFlushSeconds': 0.0,
+            'maxFlushSeconds': 0.0,
+            'totalFlushSeconds': 0.0,
+        }
 
-    def print(self, *a, **k):
-        if self._debug:
-            print('DatabaseWorker._inUse=', self._inUse)
-            print(*a, **k)
+        self._ageTimer = None  # threading.Timer that writes the queue after maxAge, when the background flusher is off
+        self._dirtySince = None  # time.monotonic() when an obj was added to self._dirty, the timer writes it after maxAge
+        self._flushing = False  # True while _WritePending() is writing changes it took from self._pending
+        self._local = threading.local()  # .levels is the list of _TransactionLevel() of this thread's open Transaction()
 
-    def RegisterDBURI(self, dburi):
-        self.print('RegisterDBURI(', dburi)
+        # self._workerLock protects the in-memory state above and is only held for a moment, never while waiting
+        # on the database or while calling LoadKey()/DumpKey().
+        # self._writeLock is held while writing to the database. When both are needed, take self._writeLock first.
+        # Both are re-entrant because BaseTable.__del__() can call Upsert() from the garbage collector
+        # while this thread is already holding them.
+        self._workerLock = TimedLock(threading.RLock(), 'workerLock', metrics)
+        self._writeLock = TimedLock(threading.RLock(), 'writeLock', metrics)
+
+    def RegisterDBURI(self, dburi, poolSize=None):
+        apiLog.debug('RegisterDBURI(%s, poolSize=%s)', dburi, poolSize)
         if dburi is None:
             if sys.platform.startswith('win'):
                 dburi = 'sqlite:///MyDatabase.db'
@@ -37,172 +174,1327 @@ class DatabaseWorker:
                 dburi = 'sqlite:////MyDatabase.db'
 
         self._dburi = dburi
-        self._db = dataset.connect(
-            self._dburi,
-            engine_kwargs={'connect_args': {'check_same_thread': False}} if 'sqlite' in self._dburi else None
+        if 'sqlite' in self._dburi:
             # to avoid error; ProgrammingError: SQLite objects created in a thread can only be used in that ame thread.The object was created in thread id 23508 and this is thread id 640
-        )
+            engineKwargs = {'connect_args': {'check_same_thread': False}}
+        elif poolSize is not None:
+            engineKwargs = {'pool_size': poolSize}
+        else:
+            engineKwargs = None
+
+        oldEngine = self._db.engine if self._db is not None else None
+        self._db = _Database(self._dburi, engine_kwargs=engineKwargs)
+
+        url = self._db.engine.url
+        if url.get_backend_name() == 'sqlite':
+            event.listen(self._db.engine, 'connect', _DisableAutoBegin)
+            event.listen(self._db.engine, 'begin', _Begin)
+            if url.database not in (None, '', ':memory:'):
+                event.listen(self._db.engine, 'connect', _EnableWAL)
+        metrics.AddEngine(self._db.engine, replaces=oldEngine)
+
+    def SetFlushPolicy(self, maxPending=None, maxAge=None, background=None):
+        apiLog.debug('SetFlushPolicy(maxPending=%s, maxAge=%s, background=%s)', maxPending, maxAge, background)
+        if maxPending is not None:
+            self._maxPending = maxPending
+        if maxAge is not None:
+            self._maxAge = maxAge
+
+        if background is True and self._flusherThread is None:
+            self._background = True
+            self._flusherThread = threading.Thread(target=self._FlusherLoop, name='dictabase-flusher', daemon=True)
+            self._flusherThread.start()
+        elif background is False:
+            self._StopFlusher()
+        self._wakeFlusher.set()  # so that a new maxAge is used right away
+
+    def _FlusherLoop(self):
+        while self._background:
+            self._wakeFlusher.wait(self._maxAge)
+            self._wakeFlusher.clear()
+            if not self._background:
+                break
+
+            try:
+                self.Flush()
+            except Exception:
+                # the changes have been put back in the queue, they are tried again next time
+                sqlLog.exception('background Flush() failed')
+
+    def _StopFlusher(self):
+        thread = self._flusherThread
+        self._background = False
+        self._flusherThread = None
+        if thread is not None:
+            self._wakeFlusher.set()
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def FlushStats(self):
+        '''
+        :return: dict with the queue depth and how long writing the queue has taken
+        '''
+        with self._workerLock:
+            ret = dict(self._flushStats)
+            ret['pendingRows'] = self._numPending
+            ret['pendingSeconds'] = time.monotonic() - self._pendingSince if self._pendingSince is not None else 0.0
+            ret['dirtyObjects'] = sum(len(objs) for objs in self._dirty.values())
+        ret['releasedObjects'] = len(self._released)
+        return ret
 
     def Insert(self, cls, **kwargs):
-        self.print('Insert', cls, kwargs)
+        sqlLog.debug('Insert(%s, %s)', cls, kwargs)
 
         obj = cls(**kwargs)
+        obj._worker = self
 
-        with self._workerLock:
+        tableName = type(obj).__name__  # do this before DumpKeys
+        dumpedObj = self._DumpKeys(obj)
+
+        with self._writeLock:
             self._db.begin()
-            tableName = type(obj).__name__  # do this before DumpKeys
-            dumpedObj = DumpKeys(obj)
-            d = dict(dumpedObj)
-            ID = self._db[tableName].insert(dumpedObj)
-            self._db.commit()
+            try:
+                ID = self._db.Schema(tableName).Insert(dumpedObj)
+                self._db.commit()
+            except Exception:
+                self._db.rollback()  # for example a duplicate value in one of the __uniqueIndexes__
+                raise
+        self._InvalidateQueries(cls)
 
-            obj['id'] = ID
-            self.AddToInUse(obj)
+        dict.__setitem__(obj, 'id', ID)
+        obj._MarkClean(dumpedObj)
+        self.AddToInUse(obj)
+        self._Touched(cls, [ID], inserted=[obj])
 
+        self.EnsureIndexes(cls, throttled=True)
         return obj
 
+    def InsertMany(self, cls, rows, chunkSize=1000, keepInUse=False):
+        sqlLog.debug('InsertMany(%s, chunkSize=%s, keepInUse=%s)', cls, chunkSize, keepInUse)
+
+        rows = iter(rows)
+        ret = []
+        while True:
+            objs = [cls(**row) for row in itertools.islice(rows, chunkSize)]
+            if not objs:
+                break
+            for obj in objs:
+                obj._worker = self
+
+            dumpedObjs = [self._DumpKeys(obj) for obj in objs]
+
+            with self._writeLock:
+                self._db.begin()
+                try:
+                    IDs = self._InsertChunk(cls.__name__, dumpedObjs)
+                    self._db.commit()
+                except Exception:
+                    self._db.rollback()
+                    raise
+            self._InvalidateQueries(cls)
+
+            if keepInUse:
+                for obj, dumpedObj, ID in zip(objs, dumpedObjs, IDs):
+                    dict.__setitem__(obj, 'id', ID)
+                    obj._MarkClean(dumpedObj)
+                    self.AddToInUse(obj)
+                ret.extend(objs)
+                self._Touched(cls, IDs, inserted=objs)
+            else:
+                ret.extend(IDs)
+                self._Touched(cls, IDs)
+
+        self.EnsureIndexes(cls, throttled=True)
+        return ret
+
+    def _DumpKeys(self, obj):
+        if not metrics.enabled:
+            return DumpKeys(obj)
+        start = time.perf_counter()
+        dumpedObj = DumpKeys(obj)
+        metrics.AddKeyTime('DumpKey', type(obj), len(dumpedObj), time.perf_counter() - start)
+        return dumpedObj
+
+    def _InsertChunk(self, tableName, dumpedObjs):
+        # must be called inside a transaction, returns the new ids in the same order as dumpedObjs
+        schema = self._db.Schema(tableName)
+
+        if self._db.engine.dialect.name != 'sqlite' or any('id' in d for d in dumpedObjs):
+            return [schema.Insert(d) for d in dumpedObjs]
+
+        # sqlite gives the rows of one executemany() consecutive ids, so they dont have to be fetched one by one.
+        # The write lock and the transaction keep anyone else from inserting in between.
+        schema.InsertMany(dumpedObjs)
+        lastID = self._db.executable.execute(
+            'SELECT max(id) FROM "{}"'.format(schema.table.name)
+        ).scalar()
+        return list(range(lastID - len(dumpedObjs) + 1, lastID + 1))
+
+    def EnsureIndexes(self, cls, blocking=True, throttled=False):
+        '''
+        Creates the indexes declared on cls, like:
+
+            class User(BaseTable):
+                __indexes__ = [('owner_id', 'created')]
+                __uniqueIndexes__ = [('email',)]
+
+        An index can only be created once all of its columns exist,
+        so this is tried again when the table is used until all of them have been created.
+
+        :param blocking: bool - False for reads, they never wait for another thread's write to create an index
+        :param throttled: bool - look for missing indexes at most once a second, always True when blocking is False
+        An index that can not be created, for example a unique index on a column with duplicate values,
+        only raises when blocking is True and throttled is False. Otherwise it is logged and tried again a minute later.
+        '''
+        if cls in self._indexedClasses:
+            return
+        if (throttled or not blocking) and time.monotonic() < self._indexRetryAt.get(cls, 0):
+            return
+        self._indexRetryAt[cls] = time.monotonic() + 1
+
+        # looking does not need the lock, only creating does
+        missing, allColumnsExist = self._MissingIndexes(cls)
+        if missing:
+            if not self._writeLock.acquire(blocking=blocking):
+                return
+            try:
+                missing, allColumnsExist = self._MissingIndexes(cls)  # another thread may have created them
+                tbl = self._db[cls.__name__]
+                self._db.begin()
+                try:
+                    for unique, columns in missing:
+                        sqlLog.debug('EnsureIndexes create index %s %s unique=%s', cls, columns, unique)
+                        if unique:
+                            # not tbl.create_index(), it skips columns that have a normal index
+                            name = 'ux_{}_{}'.format(tbl.name, '_'.join(columns))
+                            Index(name, *(tbl.table.c[col] for col in columns), unique=True).create(self._db.executable)
+                        else:
+                            tbl.create_index(columns)
+                    self._db.commit()
+                except Exception:
+                    self._db.rollback()
+                    raise
+            except exc.SQLAlchemyError:
+                if blocking and not throttled:
+                    raise
+                # the read or New() that got here must not fail because of it
+                sqlLog.exception('could not create the indexes of %s', cls.__name__)
+                self._indexRetryAt[cls] = time.monotonic() + 60
+                return
+            finally:
+                self._writeLock.release()
+
+        if allColumnsExist:
+            self._indexedClasses.add(cls)
+
+    def _MissingIndexes(self, cls):
+        '''
+        :return: tuple like ([(unique, columns)], allColumnsExist) - the declared indexes that can be created now,
+            and False if some can not be created yet because their columns dont exist
+        '''
+        declared = [(False, columns) for columns in getattr(cls, '__indexes__', [])]
+        declared.extend((True, columns) for columns in getattr(cls, '__uniqueIndexes__', []))
+        if not declared:
+            return [], True
+
+        tbl = self._db[cls.__name__]
+        if not tbl.exists:
+            return [], False
+
+        missing = []
+        allColumnsExist = True
+        existing = None  # [(set of column names, unique)]
+        for unique, columns in declared:
+            columns = (columns,) if isinstance(columns, str) else tuple(columns)
+            if not all(tbl.has_column(col) for col in columns):
+                allColumnsExist = False
+                continue
+
+            if existing is None:
+                existing = [
+                    (set(index.get('column_names', [])), bool(index.get('unique')))
+                    for index in self._db.inspect.get_indexes(tbl.name, schema=self._db.schema)
+                ]
+                existing.append(({'id'}, True))  # the primary key
+
+            # a unique index also serves as a normal index, but not the other way around
+            if not any(names == set(columns) and (isUnique or not unique) for names, isUnique in existing):
+                missing.append((unique, columns))
+        return missing, allColumnsExist
+
     def Drop(self, cls):
-        self.print('Drop(', cls)
+        sqlLog.debug('Drop(%s)', cls)
 
         self._CommitAll()
 
-        with self._workerLock:
+        with self._writeLock:
             self._db.begin()
             tableName = cls.__name__
             self._db[tableName].drop()
             self._db.commit()
+            self._indexedClasses.discard(cls)
+            self._indexRetryAt.pop(cls, None)
+            self._db.schemas.pop(tableName, None)
+        self._InvalidateQueries(cls)
 
     def AddToInUse(self, obj):
-        self.print('AddToInUseQ(', obj)
-        self._inUse[type(obj)][obj['id']] = obj
+        '''
+        :return: the obj that is in use for obj['id'], another thread may have added its own obj for it first
+        '''
+        cacheLog.debug('AddToInUse(%s)', obj)
+        index = self._GetInUseIndex(type(obj))
+        index.LoadIndexedKeys(obj)
+
+        with self._workerLock:
+            inUseObj = self._inUse[type(obj)].get(obj['id'])
+            if inUseObj is None:
+                inUseObj = self._inUse[type(obj)][obj['id']] = obj
+                index.Add(obj)
+            evicted = self._MarkUsed(inUseObj)
+
+        self._Evict(evicted)
+        if inUseObj is obj and obj._HasMutableValues():
+            self.MarkDirty(obj)
+        return inUseObj
+
+    def _MarkUsed(self, obj):
+        '''
+        Call this while holding self._workerLock.
+
+        :return: list of objs that must be passed to self._Evict() after the lock is released
+        '''
+        key = (type(obj), obj['id'])
+        self._recent[key] = obj
+        self._recent.move_to_end(key)
+        if obj._HasMutableValues():
+            self.MarkDirty(obj)  # the caller can change its values in place, check it again after maxAge
+
+        evicted = []
+        while len(self._recent) > self._cacheSize:
+            evicted.append(self._recent.popitem(last=False)[1])
+        self._cacheStats['evictions'] += len(evicted)
+        return evicted
+
+    def _Evict(self, evicted):
+        # write the changes of the evicted objs first, they may not be referenced anywhere else.
+        # Dont call this while holding self._workerLock, Upsert() calls DumpKey().
+        for obj in evicted:
+            if obj._dirtyKeys or obj._HasMutableValues():
+                metrics.Count('upsertsFromEvict')
+                self.Upsert(obj, keepInUse=True)
+
+    def SetCacheSize(self, cacheSize):
+        apiLog.debug('SetCacheSize(%s)', cacheSize)
+        with self._workerLock:
+            self._cacheSize = cacheSize
+            evicted = []
+            while len(self._recent) > self._cacheSize:
+                evicted.append(self._recent.popitem(last=False)[1])
+            self._cacheStats['evictions'] += len(evicted)
+        self._Evict(evicted)
+
+    def CacheStats(self):
+        with self._workerLock:
+            ret = dict(self._cacheStats)
+            ret['inUse'] = sum(len(objs) for objs in self._inUse.values())
+            ret['cached'] = len(self._recent)
+            ret['cacheSize'] = self._cacheSize
+        return ret
+
+    def SetQueryCache(self, cls, maxEntries=100, maxAge=60, maxRows=1000):
+        apiLog.debug('SetQueryCache(%s, maxEntries=%s, maxAge=%s, maxRows=%s)', cls, maxEntries, maxAge, maxRows)
+        with self._workerLock:
+            if not maxEntries:
+                self._queryCaches.pop(cls, None)
+            else:
+                self._queryCaches[cls] = QueryCache(maxEntries, maxAge, maxRows)
+
+    def QueryCacheStats(self):
+        with self._workerLock:
+            ret = {
+                'hits': 0,
+                'misses': 0,
+                'expired': 0,
+                'evictions': 0,
+                'invalidations': 0,
+                'entries': 0,
+            }
+            for cache in self._queryCaches.values():
+                for key, value in cache.stats.items():
+                    ret[key] += value
+                ret['entries'] += len(cache)
+        return ret
+
+    def _InvalidateQueries(self, cls):
+        # call this after a write to the table of cls has been committed
+        cache = self._queryCaches.get(cls)
+        if cache is not None:
+            with self._workerLock:
+                cache.Invalidate()
+
+    def _RememberRows(self, cache, key, version, rows):
+        # yields rows, and stores them in cache if they are all used
+        found = []
+        for row in rows:
+            if found is not None:
+                found.append(row)
+                if len(found) > cache.maxRows:
+                    found = None  # too large to keep
+            yield row
+
+        if found is not None:
+            with self._workerLock:
+                cache.Put(key, found, version)
+
+    def WatchForChanges(self, obj):
+        # called by the BaseTable obj when it has loaded a mutable value, which can be changed in place
+        if self._inUse[type(obj)].get(obj['id']) is obj:
+            self.MarkDirty(obj)
+
+    def _GetInUseIndex(self, cls):
+        index = self._inUseIndex.get(cls)
+        if index is None:
+            with self._workerLock:
+                index = self._inUseIndex.get(cls)
+                if index is None:
+                    index = self._inUseIndex[cls] = InUseIndex(self._inUse[cls])
+        return index
+
+    def KeyChanged(self, obj, key):
+        # called by the BaseTable obj after obj[key] has changed
+        if self._InTransaction():
+            self._local.levels[-1].changed.add((type(obj), obj['id']))  # undone if the transaction is rolled back
+
+        index = self._inUseIndex.get(type(obj))
+        if index is not None:
+            with self._workerLock:
+                index.Update(obj, key)
+
+    def MarkDirty(self, obj):
+        # called by the BaseTable obj when one of its keys changes
+        self._dirty[type(obj)][obj['id']] = obj
+
+        # the cache can keep obj in use after the caller dropped it, so its changes follow the maxAge of the queue
+        if self._dirtySince is None and not self._background:
+            with self._workerLock:
+                if self._dirtySince is None:
+                    self._dirtySince = time.monotonic()
+                    if self._ageTimer is None:
+                        self._StartAgeTimer(self._maxAge)
+
+    def Release(self, obj):
+        # called by BaseTable.__del__(), there are no more references to obj
+        if self._background and not self._exiting:
+            # only queue it, so the thread that dropped the last reference (or the garbage collector) never waits
+            # for the db. deque.append() is thread safe without taking a lock.
+            # obj leaves the in-use objs right away, so FindOne() cant return it again while it waits in the queue
+            with self._workerLock:
+                self._RemoveFromInUse(obj)
+            self._released.append(obj)
+        else:
+            metrics.Count('upsertsFromRelease')
+            self.Upsert(obj)
 
     def Upsert(self, obj, keepInUse=False):
-        self.print('Upsert(', obj, ',keepInUse=', keepInUse)
+        cacheLog.debug('Upsert(%s, keepInUse=%s)', obj, keepInUse)
         # this is called when there are no more references to a BaseTable() object (aka obj.__del__() is called)
 
         if not keepInUse:
-            # pop obj from inUse
-            self._inUse[type(obj)].pop(obj['id'], None)
+            with self._workerLock:
+                self._RemoveFromInUse(obj)
+        elif not obj._HasMutableValues():
+            # only objs with mutable values need to be checked again later
+            self._dirty[type(obj)].pop(obj['id'], None)
+
+        if 'id' not in obj:
+            return  # its insert was rolled back, see RollbackTransaction()
 
-        alreadyDeletedObj = self._alreadyDeletedQ[type(obj)].pop(obj['id'], None)
-        if alreadyDeletedObj:
+        index = self._inUseIndex.get(type(obj))
+        if not keepInUse and index is not None and index.Has(obj['id']):
+            # the garbage collector clears the weak reference before calling __del__() when obj was part of a cycle
+            with self._workerLock:
+                if obj['id'] not in self._inUse[type(obj)]:
+                    index.Remove(obj['id'])
+
+        if obj._deleted:
             return  # dont commit this obj. its been deleted
 
+        changes = obj._PopChanges()
+        if not changes:
+            return  # nothing has changed since this obj was last written
+
+        self._Enqueue(type(obj), obj['id'], changes)
+
+    def _RemoveFromInUse(self, obj):
+        # call this while holding self._workerLock. Another obj may be in use for the same row by now, leave that one
+        cls = type(obj)
+        if self._inUse[cls].get(obj['id']) is obj:
+            self._inUse[cls].pop(obj['id'])
+            self._GetInUseIndex(cls).Remove(obj['id'])
+        if self._dirty[cls].get(obj['id']) is obj:
+            self._dirty[cls].pop(obj['id'])
+
+    def _Enqueue(self, cls, ID, changes):
+        cacheLog.debug('_Enqueue(%s, %s, %s)', cls, ID, changes)
+
         with self._workerLock:
-            tableName = type(obj).__name__  # do this before DumpKeys
-            obj = DumpKeys(obj)
-            self._db.begin()
-            d = dict(obj)
-            self._db[tableName].upsert(d, ['id'])  # find row with matching 'id' and update it
+            rows = self._pending[cls]
+            if ID in rows:
+                rows[ID].update(changes)
+            else:
+                rows[ID] = changes
+                self._numPending += 1
+
+            if self._pendingSince is None:
+                self._pendingSince = time.monotonic()
+                self._StartAgeTimer(self._maxAge)
+
+            if self._background and not self._exiting:
+                # the background flusher writes the queue, only wake it up early if the queue is full
+                if self._numPending >= self._maxPending:
+                    self._wakeFlusher.set()
+                return
+
+            flushNow = (
+                    self._exiting or
+                    self._numPending >= self._maxPending or
+                    time.monotonic() - self._pendingSince >= self._maxAge
+            )
+
+        if flushNow:
+            # dont wait if another thread is writing, the changes stay queued until the next flush.
+            # This can be called from the garbage collector while this thread is holding self._workerLock.
+            self._WritePending(blocking=self._exiting)
+
+    def _StartAgeTimer(self, seconds):
+        # call this while holding self._workerLock.
+        # Without it, a change that no later change comes along to write would wait in the queue until Flush() or exit.
+        if self._ageTimer is not None:
+            self._ageTimer.cancel()  # (re)start it for the new deadline
+            self._ageTimer = None
+        if not self._background and not self._exiting:
+            self._ageTimer = threading.Timer(seconds, self._OnAgeTimer)
+            self._ageTimer.daemon = True
+            self._ageTimer.start()
+
+    def _OnAgeTimer(self):
+        with self._workerLock:
+            if self._ageTimer is not threading.current_thread():
+                return  # replaced by a newer timer
+            self._ageTimer = None
+            since = [t for t in (self._pendingSince, self._dirtySince) if t is not None]
+            if not since:
+                return
+            remaining = self._maxAge - (time.monotonic() - min(since))
+            if remaining > 0:
+                self._StartAgeTimer(remaining)  # the queue was written and refilled in the meantime
+                return
+
+        # dont wait behind another thread's Transaction(), try again later instead
+        if not self._writeLock.acquire(blocking=False):
+            with self._workerLock:
+                self._StartAgeTimer(self._maxAge)
+            return
+        try:
+            with self._workerLock:
+                self._dirtySince = None
+                rowsWritten = self._flushStats['rowsWritten']
+            self.Flush()
+        except Exception:
+            # the changes have been put back in the queue, which starts the timer again
+            sqlLog.exception('writing the queue after maxAge failed')
+            return
+        finally:
+            self._writeLock.release()
+
+        with self._workerLock:
+            # objs with mutable values stay in self._dirty, they can still be changed in place.
+            # Only check them again while that finds changes, otherwise DumpKey() would run for every idle obj forever.
+            # The next time one of them is found by FindOne()/FindAll() it is checked again, see _MarkUsed()
+            checkAgain = (
+                    self._dirtySince is None and
+                    self._flushStats['rowsWritten'] > rowsWritten and
+                    any(len(objs) for objs in list(self._dirty.values()))
+            )
+            if checkAgain:
+                self._dirtySince = time.monotonic()
+                if self._ageTimer is None:
+                    self._StartAgeTimer(self._maxAge)
+
+    def Flush(self, cls=None):
+        '''
+        Writes all changes of cls (or of every class if cls is None) to the database.
+        '''
+        cacheLog.debug('Flush(%s)', cls)
+
+        while self._released:
+            try:
+                obj = self._released.popleft()
+            except IndexError:
+                break  # another thread took the last one
+            metrics.Count('upsertsFromRelease')
+            self.Upsert(obj)
+
+        # only the objs that may have changed need to be written
+        for theType in [cls] if cls else list(self._dirty):
+            dirtyObjs = list(self._dirty[theType].values())
+            metrics.Count('upsertsFromFlush', len(dirtyObjs))
+            for obj in dirtyObjs:
+                self.Upsert(obj, keepInUse=True)
+
+        self._WritePending(cls)
+
+    def _WritePending(self, cls=None, blocking=True):
+        with self._workerLock:
+            if not self._flushing and (self._numPending == 0 if cls is None else not self._pending.get(cls)):
+                return  # nothing to write, and nothing is being written right now
+
+        if not self._writeLock.acquire(blocking=blocking):
+            return
+
+        wasFlushing = self._flushing
+        try:
+            with self._workerLock:
+                if cls is None:
+                    pending = self._pending
+                    self._pending = defaultdict(dict)
+                else:
+                    pending = {cls: self._pending.pop(cls, {})}
+
+                numRows = sum(len(rows) for rows in pending.values())
+                if numRows == 0:
+                    return
+
+                sqlLog.debug('_WritePending(%s rows)', numRows)
+                self._numPending -= numRows
+                if self._numPending == 0:
+                    self._pendingSince = None
+                self._flushing = True
+
+            start = time.perf_counter()
+            try:
+                try:
+                    self._WriteBatch(pending)
+                except _UNWRITABLE_ERRORS:
+                    # one row that can never be written must not keep the other rows from being written.
+                    # Inside Transaction() the failed batch was a savepoint, the rest of the transaction is still there
+                    self._WriteEach(pending)
+            except Exception:
+                self._Requeue(pending)  # so the changes that were not written are not lost
+                raise
+
+            seconds = time.perf_counter() - start
+            with self._workerLock:
+                stats = self._flushStats
+                stats['flushes'] += 1
+                stats['rowsWritten'] += numRows
+                stats['lastFlushSeconds'] = seconds
+                stats['maxFlushSeconds'] = max(stats['maxFlushSeconds'], seconds)
+                stats['totalFlushSeconds'] += seconds
+
+        finally:
+            self._flushing = wasFlushing  # True if the garbage collector called this in the middle of a write
+            self._writeLock.release()
+
+    def _Requeue(self, pending):
+        # puts {cls: {id: changes}} back in the queue, newer changes to the same keys have priority
+        with self._workerLock:
+            for theType, rows in pending.items():
+                for ID, changes in rows.items():
+                    newerChanges = self._pending[theType].get(ID)
+                    if newerChanges is None:
+                        self._numPending += 1
+                    else:
+                        changes.update(newerChanges)
+                    self._pending[theType][ID] = changes
+            if self._pendingSince is None:
+                self._pendingSince = time.monotonic()
+            self._StartAgeTimer(self._maxAge)
+
+    def _WriteBatch(self, pending):
+        # writes {cls: {id: changes}} in one transaction. Inside Transaction() this is a savepoint (see _Database.begin()),
+        # so a rollback here only undoes these rows
+        self._db.begin()
+        try:
+            for theType, rows in pending.items():
+                self._WriteRows(theType, rows)
             self._db.commit()
+        except Exception:
+            self._db.rollback()
+            raise
+        for theType in pending:
+            self._InvalidateQueries(theType)
+
+        if self._InTransaction():
+            written = self._local.levels[-1].written
+            for theType, rows in pending.items():
+                for ID, changes in rows.items():
+                    written[theType].setdefault(ID, {}).update(changes)
+
+    def _WriteEach(self, pending):
+        # writes each class, and if that fails each row, on its own. Rows that still fail are logged and dropped.
+        # Removes what is written or dropped from pending, so only the rest is put back if another error is raised.
+        for theType in list(pending):
+            rows = pending[theType]
+            try:
+                self._WriteBatch({theType: rows})
+                del pending[theType]
+                continue
+            except _UNWRITABLE_ERRORS:
+                pass
+
+            for ID in list(rows):
+                try:
+                    self._WriteBatch({theType: {ID: rows[ID]}})
+                except _UNWRITABLE_ERRORS:
+                    sqlLog.exception('dropped the changes %s to %s id=%s, they cannot be written', rows[ID], theType.__name__, ID)
+                    self._Forget(theType, [ID])  # the obj holds the values that were not written, load it again
+                del rows[ID]
+            del pending[theType]
+
+    def _WriteRows(self, cls, rows):
+        # rows that changed the same keys can be written with one executemany() UPDATE
+        schema = self._db.Schema(cls.__name__)
+
+        groups = defaultdict(list)
+        for ID, changes in rows.items():
+            groups[tuple(sorted(changes))].append(dict(changes, id=ID))
+
+        for keys, group in groups.items():
+            schema.UpdateMany(keys, group)
+
+    def _OnExit(self):
+        # from now on every change is written right away,
+        # BaseTable.__del__() will still be called during interpreter shutdown
+        self._exiting = True
+        self._StopFlusher()
+        if self._db is not None:
+            self.Flush()
 
     def Delete(self, obj):
-        self.print('Delete(', obj)
-        self._CommitAll()
+        sqlLog.debug('Delete(%s)', obj)
+        self.Flush(type(obj))
 
-        with self._workerLock:
+        with self._writeLock:
             self._db.begin()
             tableName = type(obj).__name__
             d = {'id': obj['id']}
             self._db[tableName].delete(**d)
             self._db.commit()
+        self._InvalidateQueries(type(obj))
 
-        self._alreadyDeletedQ[type(obj)][obj['id']] = obj
+        obj._deleted = True
+        self._Touched(type(obj), [obj['id']], deleted=[obj])
+        self._Forget(type(obj), [obj['id']])
 
-        self.print('Delete complete for obj=', obj)
+    def DeleteWhere(self, cls, filters):
+        '''
+        Deletes every row matching filters with one DELETE statement.
+        The in-use objs of those rows are marked as deleted and leave the in-use objs.
 
-    def FindOne(self, cls, kwargs):
-        self.print('FindOne(', cls, kwargs)
+        :return: int - number of rows deleted
+        '''
+        sqlLog.debug('DeleteWhere(%s, %s)', cls, filters)
+        self.Flush(cls)  # queued changes can decide which rows match
 
-        # if this object is already in use, return the reference
+        tbl = self._db[cls.__name__]
+        if not tbl.exists:
+            return 0
+
+        with self._writeLock:
+            self._db.begin()
+            try:
+                IDs = self._InUseMatches(tbl, cls, filters)
+                result = self._db.executable.execute(tbl.table.delete(Clause(tbl, filters, dumpKey=self._Dumper(cls).DumpKey)))
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        self._InvalidateQueries(cls)
+
+        deleted = [obj for obj in (self._inUse[cls].get(ID) for ID in IDs) if obj is not None]
+        for obj in deleted:
+            obj._deleted = True
+        self._Touched(cls, IDs, deleted=deleted)
+        self._Forget(cls, IDs)
+        return result.rowcount
+
+    def UpdateWhere(self, cls, filters, values):
+        '''
+        Sets values on every row matching filters with one UPDATE statement.
+        The in-use objs of those rows get the new values too.
+
+        :param values: dict like {key: value}, the values are passed through DumpKey() first
+        :return: int - number of rows updated
+        '''
+        sqlLog.debug('UpdateWhere(%s, %s, %s)', cls, filters, values)
+        if 'id' in values:
+            raise ValueError('UpdateWhere() cannot change the "id" of a row.')
+
+        self.Flush(cls)  # queued changes can decide which rows match, and must not overwrite the new values later
+
+        tbl = self._db[cls.__name__]
+        if not tbl.exists or not values:
+            return 0
+
+        dumper = self._Dumper(cls)
+        dumpedValues = {key: dumper.DumpKey(key, value) for key, value in values.items()}
+
+        with self._writeLock:
+            self._db.begin()
+            try:
+                self._db.Schema(tbl.name).EnsureColumns([dumpedValues])
+                IDs = self._InUseMatches(tbl, cls, filters)
+                result = self._db.executable.execute(
+                    tbl.table.update(Clause(tbl, filters, dumpKey=dumper.DumpKey)).values(dumpedValues)
+                )
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        self._InvalidateQueries(cls)
+
+        index = self._GetInUseIndex(cls)
+        for ID in IDs:
+            obj = self._inUse[cls].get(ID)
+            if obj is not None:
+                obj._SetRaw(dumpedValues)
+                index.LoadIndexedKeys(obj)
+                for key in dumpedValues:
+                    self.KeyChanged(obj, key)
+        self._Touched(cls, IDs)
+        return result.rowcount
+
+    def _InUseMatches(self, tbl, cls, filters):
+        # ids of the in-use objs whose rows match filters in the db.
+        # Only the in-use ids are looked up, so this is fast no matter how many rows match.
+        IDs = list(self._inUse[cls].keys())
+        ret = []
+        for start in range(0, len(IDs), 500):
+            query = select(
+                [tbl.table.c.id],
+                whereclause=Clause(
+                    tbl,
+                    filters,
+                    clauses=[tbl.table.c.id.in_(IDs[start:start + 500])],
+                    dumpKey=self._Dumper(cls).DumpKey,
+                ),
+            )
+            ret.extend(row[0] for row in self._db.executable.execute(query))
+        return ret
+
+    def _Forget(self, cls, IDs):
+        '''
+        Removes the in-use objs with these ids, so that FindOne()/FindAll() load them from the db again.
 
+        :return: list of the removed objs, dont drop it while holding self._workerLock because that can call their __del__()
+        '''
+        forgotten = []
         with self._workerLock:
-            for obj in self._inUse[cls].values():
-                if IsSubset(superDict=obj, subDict=dict(**kwargs)):
-                    self.print('FindOne return from inUse obj=', obj)
-                    return obj
+            index = self._GetInUseIndex(cls)
+            for ID in IDs:
+                if self._inUse[cls].pop(ID, None) is not None:
+                    index.Remove(ID)
+                self._dirty[cls].pop(ID, None)
+                forgotten.append(self._recent.pop((cls, ID), None))
+        return forgotten
 
-        self._CommitAll(keepInUse=True)
+    def BeginTransaction(self):
+        '''
+        Until the matching CommitTransaction(), nothing this thread writes is committed.
+        Calling this again inside a transaction starts a savepoint.
+        Other threads can still read, but their writes wait until the transaction is finished.
+        '''
+        sqlLog.debug('BeginTransaction()')
+        self._writeLock.acquire()  # released by CommitTransaction()/RollbackTransaction()
+        try:
+            # changes made before the transaction (or savepoint) must not be undone by rolling it back
+            self.Flush()
+            if not self._InTransaction():
+                self._local.levels = []
+            self._db.begin()  # a savepoint inside a transaction, see _Database.begin()
+        except Exception:
+            self._writeLock.release()
+            raise
 
-        # self._db.begin() # dont do this
+        self._local.levels.append(_TransactionLevel())
+
+    def CommitTransaction(self):
+        sqlLog.debug('CommitTransaction()')
+        try:
+            self.Flush()  # changes made inside the transaction are part of it
+            self._db.commit()
+        except Exception:
+            self.RollbackTransaction()
+            raise
+
+        level = self._local.levels.pop()
+        if self._local.levels:
+            level.MergeInto(self._local.levels[-1])
+        else:
+            # other threads can see these changes from now on
+            for cls in set(level.touched) | set(level.written):
+                self._InvalidateQueries(cls)
+
+        self._writeLock.release()
+
+    def RollbackTransaction(self):
+        '''
+        Rolls back the changes this thread made since the matching BeginTransaction().
+        Changes of other threads that were written in the meantime are queued again instead of being lost.
+        '''
+        sqlLog.debug('RollbackTransaction()')
+        level = self._local.levels[-1]
+        try:
+            self._db.rollback()
+        finally:
+            self._local.levels.pop()
+            try:
+                requeue = {}
+                for cls, rows in level.written.items():
+                    rows = {ID: changes for ID, changes in rows.items() if (cls, ID) not in level.changed}
+                    if rows:
+                        requeue[cls] = rows
+                if requeue:
+                    self._Requeue(requeue)
+
+                # the changes of this thread that were not written yet are rolled back too
+                with self._workerLock:
+                    changedObjs = []
+                    for cls, ID in level.changed:
+                        if self._pending[cls].pop(ID, None) is not None:
+                            self._numPending -= 1
+                        changedObjs.append(self._inUse[cls].get(ID))
+                    if self._numPending == 0:
+                        self._pendingSince = None
+                for obj in changedObjs:
+                    if obj is not None:
+                        obj._PopChanges()
+            finally:
+                self._writeLock.release()
+
+        # the objs this thread wrote or changed in the transaction no longer match the db,
+        # forget them so that FindOne()/FindAll() load them from the db again
+        for cls, ID in level.changed:
+            level.touched[cls].add(ID)
+        for cls, IDs in level.touched.items():
+            self._Forget(cls, IDs)
+
+        for obj in level.inserted:
+            dict.pop(obj, 'id', None)  # these objs are not in the db
+        for obj in level.deleted:
+            obj._deleted = False  # these rows are still in the db
+
+    def _InTransaction(self):
+        return bool(getattr(self._local, 'levels', None))
+
+    def _Touched(self, cls, IDs, inserted=(), deleted=()):
+        # remember which rows were written in the open transaction of this thread
+        if self._InTransaction():
+            level = self._local.levels[-1]
+            level.touched[cls].update(IDs)
+            level.inserted.extend(inserted)
+            level.deleted.extend(deleted)
+
+    def FindOne(self, cls, kwargs):
+        sqlLog.debug('FindOne(%s, %s)', cls, kwargs)
+
+        # special kwargs
+        columns = kwargs.pop('_columns', None)  # list of str - only load these keys, the obj is not kept in use
 
+        # if this object is already in use, return the reference
+        index = self._GetInUseIndex(cls)
+        match = self._Matcher(kwargs)
+        index.LoadSearchedKeys(kwargs)
         with self._workerLock:
+            foundInUse = index.Find(kwargs, match)
+            if foundInUse:
+                self._cacheStats['hits'] += 1
+                evicted = self._MarkUsed(foundInUse[0])
+            else:
+                self._cacheStats['misses'] += 1
 
-            tableName = cls.__name__
-            tbl = self._db[tableName]
-            ret = tbl.find_one(**kwargs)
-            if ret:
+        if foundInUse:
+            self._Evict(evicted)
+            cacheLog.debug('FindOne hit in-use %s', foundInUse[0])
+            return foundInUse[0]
+
+        self._CommitAll(keepInUse=True, cls=cls)
+        self.EnsureIndexes(cls, blocking=False)
+
+        # self._db.begin() # dont do this
+        # no lock is needed to read, this thread has its own connection
+
+        tableName = cls.__name__
+        tbl = self._db[tableName]
+        ret = next(self._Find(cls, tbl, kwargs, columns=columns, limit=1, batchSize=None), None)  # fetchall() closes the cursor
+        if ret:
+            inUseObj = self._inUse[cls].get(ret['id'])
+            if inUseObj is not None:
+                ret = inUseObj
+            else:
                 ret = cls(**ret)
+                ret._worker = self
                 ret = LoadKeys(ret)
-                self.AddToInUse(ret)
-            else:
-                ret = None
+                if columns is None:
+                    ret = self.AddToInUse(ret)
+        else:
+            ret = None
 
         return ret
 
-    def FindAll(self, cls, kwargs):
-        self.print('FindAll(', cls, kwargs)
+    def _Matcher(self, kwargs):
+        return Matcher(kwargs, dialect=self._db.engine.dialect.name)
 
-        with self._workerLock:
-            foundInUse = []
-            for obj in self._inUse[cls].values():
-                if IsSubset(superDict=obj, subDict=dict(**kwargs)):
-                    foundInUse.append(obj)
+    def _Dumper(self, cls):
+        dumper = self._dumpers.get(cls)
+        if dumper is None:
+            # DumpKey() is a method, but __init__() may need arguments. This obj has no 'id', so it is never written
+            dumper = self._dumpers[cls] = cls.__new__(cls)
+        return dumper
+
+    def _Find(self, cls, tbl, kwargs, clauses=(), columns=None, orderBy=None, limit=None, offset=0, batchSize=1000):
+        # returns an iterable of dict rows
+        if not tbl.exists:
+            return iter([])
+
+        whereclause = Clause(tbl, kwargs, clauses=clauses, dumpKey=self._Dumper(cls).DumpKey)
+        query = self._Select(tbl, whereclause, columns, orderBy, limit, offset)
+        return ResultIter(self._Read(query), row_type=dict, step=batchSize)
+
+    def _Read(self, query):
+        # reads dont take self._writeLock, so they can see a table or column that another thread is still creating
+        # in a transaction it has not committed yet. Wait for that transaction and try once more.
+        try:
+            return self._db.executable.execute(query)
+        except exc.OperationalError as e:
+            if not any(message in str(e) for message in ('no such table', 'no such column', 'does not exist')):
+                raise
+        with self._writeLock:
+            pass
+        return self._db.executable.execute(query)
 
-        self._CommitAll(keepInUse=True)
+    def _Select(self, tbl, whereclause, columns, orderBy, limit, offset):
+        if columns is None:
+            query = tbl.table.select(whereclause=whereclause, limit=limit, offset=offset)
+        else:
+            # SELECT only the requested columns, 'id' is always needed
+            columns = ['id'] + [col for col in columns if col != 'id']
+            query = select(
+                [tbl.table.c[col] for col in columns if tbl.has_column(col)],
+                whereclause=whereclause,
+                limit=limit,
+                offset=offset,
+            )
+        orderings = tbl._args_to_order_by(orderBy)
+        if orderings:
+            query = query.order_by(*orderings)
+        return query
+
+    def _FindRows(self, cls, tbl, kwargs, clauses=(), columns=None, orderBy=None, limit=None, offset=0, batchSize=1000):
+        # same as _Find(), but yields read-only Rows that share one RowLayout, instead of a dict per row
+        if not tbl.exists:
+            return
+
+        dumper = self._Dumper(cls)
+        whereclause = Clause(tbl, kwargs, clauses=clauses, dumpKey=dumper.DumpKey)
+        result = self._Read(self._Select(tbl, whereclause, columns, orderBy, limit, offset))
+        try:
+            layout = RowLayout(result.keys())
+            if type(dumper).LoadKey is BaseTable.LoadKey:
+                loaders = None
+            else:
+                # like a BaseTable obj, LoadKey() is called for every key but 'id'
+                loaders = [None if key == 'id' else key for key in layout.keys]
+
+            while True:
+                rows = result.fetchmany(batchSize)
+                if not rows:
+                    break
+
+                if loaders is None:
+                    for row in rows:
+                        yield Row(layout, tuple(row))
+                else:
+                    for row in rows:
+                        yield Row(layout, tuple(
+                            value if key is None else dumper.LoadKey(key, value) for key, value in zip(loaders, row)
+                        ))
+        finally:
+            result.close()
+
+    def FindAll(self, cls, kwargs):
+        sqlLog.debug('FindAll(%s, %s)', cls, kwargs)
+
+        # results in the query cache are found by all the kwargs, special kwargs included
+        cacheKey = FreezeKwargs({key: value for key, value in kwargs.items() if key != '_batchSize'})
 
         # special kwargs
         reverse = kwargs.pop('_reverse', False)  # bool
         orderBy = kwargs.pop('_orderBy', None)  # str
-        if reverse is True:
-            if orderBy is not None:
-                orderBy = '-' + orderBy
-            else:
-                orderBy = '-id'
+        limit = kwargs.pop('_limit', None)  # int - return at most this many objs
+        offset = kwargs.pop('_offset', 0)  # int - skip this many objs
+        after = kwargs.pop('_after', None)  # only return objs that come after this one, see _AfterClause()
+        detached = kwargs.pop('_detached', False)  # bool - dont keep the found objs in use
+        batchSize = kwargs.pop('_batchSize', 1000)  # int - number of rows fetched from the db at a time
+        columns = kwargs.pop('_columns', None)  # list of str - only load these keys
+        readonly = kwargs.pop('_readonly', False)  # bool - yield read-only Rows instead of objs, see dictabase.row
 
-        # do look up
-        with self._workerLock:
-            tableName = cls.__name__
+        if columns is not None:
+            # partial objs are never kept in use, FindOne()/FindAll() should only return complete objs from there
+            detached = True
 
-            if len(kwargs) == 0:
-                if tableName not in self._db:
-                    newTable = self._db[tableName]  # create a new table
+        match = self._Matcher(kwargs)  # checks the filters before anything is written
 
-                foundInDB = self._db[tableName].all(order_by=[f'{orderBy}'])
-            else:
-                if orderBy is not None:
-                    foundInDB = self._db[tableName].find(
-                        order_by=['{}'.format(orderBy)],
-                        **kwargs
-                    )
-                else:
-                    foundInDB = self._db[tableName].find(**kwargs)
+        orderColumn = orderBy or 'id'
+        if orderBy is not None or reverse is True:
+            direction = '-' if reverse is True else ''
+            orderBy = [direction + orderColumn]
+            if orderColumn != 'id':
+                orderBy.append(direction + 'id')  # rows with the same value always come in the same order
+
+        self._CommitAll(keepInUse=True, cls=cls)
+        self.EnsureIndexes(cls, blocking=False)
+
+        # do look up, no lock is needed to read
+        tbl = self._db[cls.__name__]
+
+        clauses = []
+        if after is not None and tbl.exists:
+            clauses.append(self._AfterClause(cls, tbl, orderColumn, after, reverse is True))
+
+        cache = self._queryCaches.get(cls)
+        if cacheKey is None or self._InTransaction():
+            cache = None  # other threads must not find rows this transaction has not committed
+
+        foundInDB = None
+        if cache is not None:
+            with self._workerLock:
+                version = cache.version
+                foundInDB = cache.Get(cacheKey)
+
+        if foundInDB is None:
+            foundInDB = (self._FindRows if readonly else self._Find)(
+                cls,
+                tbl,
+                kwargs,
+                clauses=clauses,
+                columns=columns,
+                orderBy=orderBy,
+                limit=limit,
+                offset=offset,
+                batchSize=batchSize,
+            )
+            if cache is not None:
+                foundInDB = self._RememberRows(cache, cacheKey, version, foundInDB)
+
+        if readonly:
+            # the db is up to date with the in-use objs now, and Rows are never kept in use
+            yield from foundInDB
+            return
 
         # yield type-cast items one by one
-        alreadyYielded = set()  # set() of int(id)
-        self.print('foundInUse=', foundInUse)
-
-        for obj in foundInUse:  # in use has priority
-            self.AddToInUse(obj)
-            alreadyYielded.add(obj['id'])
-            self.print('FindAll foundInUse yield obj=', obj)
-            yield obj
-
-        for d in foundInDB:
-            self.print('foundInDB d=', d)
-            self.print('alreadyYielded=', alreadyYielded)
-
-            if d['id'] not in alreadyYielded:
-                obj = cls(**d)
-                obj = LoadKeys(obj)
-                self.AddToInUse(obj)
-                alreadyYielded.add(obj['id'])
-                self.print('FindAll foundInDB yield obj=', obj)
+        # the db is up to date with the in-use objs now, so the db decides what is found and in what order
+        alreadyYielded = None if detached else set()  # set() of int(id)
+
+        hits = misses = 0
+        try:
+            for d in foundInDB:
+                obj = self._inUse[cls].get(d['id'])  # in use has priority
+                if obj is None:
+                    misses += 1
+                    obj = cls(**d)
+                    obj._worker = self
+                    obj = LoadKeys(obj)
+                    if not detached:
+                        obj = self.AddToInUse(obj)
+                else:
+                    hits += 1
+                    if not detached:
+                        with self._workerLock:
+                            evicted = self._MarkUsed(obj)
+                        self._Evict(evicted)
+
+                if alreadyYielded is not None:
+                    alreadyYielded.add(obj['id'])
                 yield obj
+        finally:
+            with self._workerLock:
+                self._cacheStats['hits'] += hits
+                self._cacheStats['misses'] += misses
+
+        if alreadyYielded is not None and limit is None and not offset and after is None:
+            # LoadKey() can change a value so that an obj matches kwargs in memory but not in the db
+            index = self._GetInUseIndex(cls)
+            index.LoadSearchedKeys(kwargs)
+            with self._workerLock:
+                foundInUse = index.Find(kwargs, match)
+
+            cacheLog.debug('FindAll found %s in-use objects', len(foundInUse))
+            for obj in foundInUse:
+                if obj['id'] not in alreadyYielded:
+                    yield obj
+
+    def _AfterClause(self, cls, tbl, orderColumn, after, reverse):
+        '''
+        Keyset pagination, the rows that come after the last row of the previous page, ordered by orderColumn and then id.
+
+        :param after: the 'id' of the last obj when ordering by 'id',
+            otherwise a tuple like (obj[orderColumn], obj['id']) so that rows with the same value are not skipped
+        '''
+        if not tbl.has_column(orderColumn):
+            raise ValueError('Cannot use _after with _orderBy="{}", table "{}" has no such column.'.format(
+                orderColumn, tbl.name))
+
+        idColumn = tbl.table.c.id
+        if orderColumn == 'id':
+            return idColumn < after if reverse else idColumn > after
 
-    def _CommitAll(self, keepInUse=False):
-        self.print('CommitAll(keepInUse=', keepInUse)
+        if not isinstance(after, (tuple, list)) or len(after) != 2:
+            raise ValueError('With _orderBy="{0}", _after must be a tuple like (obj["{0}"], obj["id"]) of the last obj.'.format(
+                orderColumn))
 
-        for theType in self._inUse:
-            for obj in self._inUse[theType].copy().values():
-                self.Upsert(obj, keepInUse=keepInUse)
+        value, ID = after
+        column = tbl.table.c[orderColumn]
+        laterID = idColumn < ID if reverse else idColumn > ID
+        # NULL comes before every value, so first when ascending and last when descending
+        if value is None:
+            return and_(column.is_(None), laterID) if reverse else or_(column.isnot(None), and_(column.is_(None), laterID))
+
+        value = self._Dumper(cls).DumpKey(orderColumn, value)
+        later = or_(column < value, column.is_(None)) if reverse else column > value
+        return or_(later, and_(column == value, laterID))
+
+    def Aggregate(self, cls, function, key, filters, groupBy=None):
+        '''
+        Runs an SQL aggregate over the rows matching filters, no objs are created.
+
+        :param function: str - 'count', 'sum', 'min' or 'max'
+        :param key: str - the column to aggregate, or None to count rows
+        :param groupBy: str - if given, return one result per value of this key
+        :return: the result, or dict like {groupValue: result}
+        '''
+        sqlLog.debug('Aggregate(%s, %s, %s, %s, groupBy=%s)', cls, function, key, filters, groupBy)
+
+        # only the queued changes of this class can change the result
+        self.Flush(cls)
+        self.EnsureIndexes(cls, blocking=False)
+
+        tbl = self._db[cls.__name__]
+        if not tbl.exists:
+            return {} if groupBy is not None else (0 if function == 'count' else None)
+
+        dumper = self._Dumper(cls)
+        if key is None:
+            aggregate = func.count()
+        else:
+            # a column that does not exist is NULL in every row
+            aggregate = getattr(func, function)(tbl.table.c[key] if tbl.has_column(key) else null())
+
+        whereclause = Clause(tbl, filters, dumpKey=dumper.DumpKey)
+
+        if groupBy is None:
+            query = select([aggregate], whereclause=whereclause).select_from(tbl.table)
+            value = self._Read(query).scalar()
+            return self._LoadAggregate(dumper, function, key, value)
+
+        if not tbl.has_column(groupBy):
+            # every matching row is in the None group
+            query = select([aggregate, func.count()], whereclause=whereclause).select_from(tbl.table)
+            value, numRows = self._Read(query).first()
+            return {None: self._LoadAggregate(dumper, function, key, value)} if numRows else {}
+
+        column = tbl.table.c[groupBy]
+        query = select([column, aggregate], whereclause=whereclause).group_by(column)
+        ret = {}
+        for groupValue, value in self._Read(query):
+            if groupValue is not None:
+                loadedValue = dumper.LoadKey(groupBy, groupValue)
+                groupValue = loadedValue if IsHashable(loadedValue) else groupValue
+            ret[groupValue] = self._LoadAggregate(dumper, function, key, value)
+        return ret
+
+    def FindColumns(self, cls, columns, filters, orderBy=None, reverse=False, limit=None, offset=0, batchSize=10000):
+        '''
+        Reads only the given columns of the rows matching filters, no objs are created.
+        cls.LoadKey() is only called if cls overrides it.
+
+        :param columns: list of str
+        :return: generator of lists of tuples, one tuple per row with a value for each column
+        '''
+        sqlLog.debug('FindColumns(%s, %s, %s)', cls, columns, filters)
+
+        self.Flush(cls)
+        self.EnsureIndexes(cls, blocking=False)
+
+        tbl = self._db[cls.__name__]
+        if not tbl.exists:
+            return
+
+        dumper = self._Dumper(cls)
+        loadKey = None if type(dumper).LoadKey is BaseTable.LoadKey else dumper.LoadKey
+
+        # a column that does not exist is NULL in every row
+        query = select(
+            [tbl.table.c[col] if tbl.has_column(col) else null() for col in columns],
+            whereclause=Clause(tbl, filters, dumpKey=dumper.DumpKey),
+            limit=limit,
+            offset=offset,
+        ).select_from(tbl.table)
+        orderings = tbl._args_to_order_by(('-' if reverse else '') + (orderBy or 'id'))
+        if orderings:
+            query = query.order_by(*orderings)
+
+        result = self._Read(query)
+        try:
+            while True:
+                rows = result.fetchmany(batchSize)
+                if not rows:
+                    break
+
+                if loadKey is None:
+                    yield [tuple(row) for row in rows]
+                else:
+                    yield [
+                        tuple(None if value is None else loadKey(col, value) for col, value in zip(columns, row))
+                        for row in rows
+                    ]
+        finally:
+            result.close()
+
+    def _LoadAggregate(self, dumper, function, key, value):
+        # min/max return a stored value, count/sum return a number
+        if function in ('min', 'max') and value is not None:
+            return dumper.LoadKey(key, value)
+        if function == 'count':
+            return value or 0
+        return value
+
+    def Exists(self, cls, filters):
+        sqlLog.debug('Exists(%s, %s)', cls, filters)
+
+        self.Flush(cls)
+        self.EnsureIndexes(cls, blocking=False)
+
+        tbl = self._db[cls.__name__]
+        if not tbl.exists:
+            return False
+
+        # stops at the first matching row instead of counting them all
+        query = select([tbl.table.c.id], whereclause=Clause(tbl, filters, dumpKey=self._Dumper(cls).DumpKey), limit=1)
+        return self._Read(query).first() is not None
+
+    def _CommitAll(self, keepInUse=False, cls=None):
+        cacheLog.debug('_CommitAll(keepInUse=%s, cls=%s)', keepInUse, cls)
+
+        self.Flush(cls)
+
+        if not keepInUse:
+            with self._workerLock:
+                for theType in list(self._inUse):
+                    self._inUse[theType].clear()
+                    self._dirty[theType].clear()
+                    self._GetInUseIndex(theType).Clear()
+                recent = self._recent
+                self._recent = OrderedDict()
+            recent.clear()  # drop the objs only now that the lock is released, that can call their __del__()
@@ -1,9 +1,26 @@
 import time
+import datetime
+import decimal
+import logging
+
+# Nothing is formatted unless the logger is enabled, for example:
+#   logging.getLogger('dictabase.sql').setLevel(logging.DEBUG)
+apiLog = logging.getLogger('dictabase.api')  # calls to New(), FindOne(), FindAll(), etc
+sqlLog = logging.getLogger('dictabase.sql')  # work that reads/writes the database
+cacheLog = logging.getLogger('dictabase.cache')  # in-use objects and the write-behind queue
+slowLog = logging.getLogger('dictabase.slow')  # operations slower than SetMetrics(slowSeconds=...), logged as warnings
+logging.getLogger('dictabase').addHandler(logging.NullHandler())
+logging.getLogger('dictabase').setLevel(logging.WARNING)  # off by default, see dictabase.SetDebug()
+
+IMMUTABLE_TYPES = (
+    type(None), bool, int, float, complex, str, bytes, tuple, frozenset,
+    datetime.date, datetime.time, datetime.timedelta, decimal.Decimal,
+)
 
 
 def LoadKeys(obj):
-    for k, v in obj.copy().items():
-        obj[k] = obj.LoadKey(k, v)
+    # obj.LoadKey() is called for each key the first time that key is used, see BaseTable.__getitem__()
+    obj._MarkRaw()
     return obj
 
 
@@ -38,4 +55,34 @@ class ExponentialDelay:
 
 
 def IsSubset(subDict, superDict):
-    return all(item in superDict.items() for item in subDict.items())
+    return all(key in superDict and superDict[key] == value for key, value in subDict.items())
+
+
+def IsMutable(value):
+    # values that can be changed in place without calling BaseTable.__setitem__()
+    return not isinstance(value, IMMUTABLE_TYPES)
+
+
+def ShallowCopy(value):
+    # returns a copy that can be compared with value to see if value has been changed in place,
+    # or None if there is no cheap way to do that, for this type or because value holds mutable values itself
+    if type(value) is bytearray:
+        return bytearray(value)
+    if type(value) in (list, set):
+        items = value
+    elif type(value) is dict:
+        items = value.values()
+    else:
+        return None
+
+    if any(IsMutable(item) for item in items):
+        return None  # a change inside an item would not show in the copy
+    return type(value)(value)
+
+
+def IsHashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
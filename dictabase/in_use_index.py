@@ -0,0 +1,107 @@
+from dictabase.helpers import IsHashable
+from dictabase.query import IsPlainValue
+
+
+class InUseIndex:
+    # hash index of the in-use objects of one class, so that lookups like FindOne(User, email=...) dont have to
+    # check every in-use object. The index for a key is only built the first time that key is searched for,
+    # after that it is kept up to date by Add(), Remove() and Update().
+
+    def __init__(self, inUse):
+        self._inUse = inUse  # {id: obj} shared with the DatabaseWorker
+        self._buckets = {}  # {key: {value: {id: None}}}, the inner dicts are used as ordered sets
+        self._indexedValues = {}  # {key: {id: value}}, the value each obj is currently indexed under
+
+    def Add(self, obj):
+        for key in self._buckets:
+            self._AddKey(key, obj)
+
+    def Remove(self, ID):
+        for key in self._buckets:
+            self._RemoveKey(key, ID)
+
+    def Update(self, obj, key):
+        # call this after obj[key] has changed
+        if key in self._buckets and self._inUse.get(obj['id']) is obj:
+            self._RemoveKey(key, obj['id'])
+            self._AddKey(key, obj)
+
+    def Has(self, ID):
+        # True if there is an obj with this id in the index
+        return any(ID in indexedValues for indexedValues in self._indexedValues.values())
+
+    def LoadIndexedKeys(self, obj):
+        # LoadKey() can run any code, including FindOne(), so call this before Add() instead of under the worker lock
+        for key in list(self._buckets):
+            obj.get(key)
+
+    def LoadSearchedKeys(self, kwargs):
+        # same as LoadIndexedKeys(), for the values Find(kwargs) will have to look at
+        for key, value in kwargs.items():
+            if key not in self._buckets or not IsPlainValue(value):
+                for obj in list(self._inUse.values()):
+                    obj.get(key)
+
+    def Clear(self):
+        self._buckets.clear()
+        self._indexedValues.clear()
+
+    def Find(self, kwargs, match):
+        '''
+        :param kwargs: dict like the kwargs of FindAll(), the plain values are looked up in the index
+        :param match: function(obj) -> bool, see dictabase.query.Matcher()
+        :return: list of in-use objects that match
+        '''
+        if not kwargs:
+            return list(self._inUse.values())
+
+        candidateIDs = None
+        for key, value in kwargs.items():
+            if not IsPlainValue(value):
+                continue  # this key has to be checked the slow way
+
+            IDs = self._GetBucket(key, value)
+            if candidateIDs is None or len(IDs) < len(candidateIDs):
+                candidateIDs = IDs
+            if not candidateIDs:
+                return []
+
+        if candidateIDs is None:
+            candidateIDs = self._inUse  # no key could use the index, check every obj
+
+        ret = []
+        for ID in list(candidateIDs):
+            obj = self._inUse.get(ID)
+            if obj is not None and match(obj):
+                ret.append(obj)
+        return ret
+
+    def _GetBucket(self, key, value):
+        if key not in self._buckets:
+            self._buckets[key] = {}
+            self._indexedValues[key] = {}
+            for obj in list(self._inUse.values()):
+                self._AddKey(key, obj)
+
+        return self._buckets[key].get(value, {})
+
+    def _AddKey(self, key, obj):
+        if key not in obj:
+            return
+
+        value = obj[key]
+        if IsHashable(value):
+            self._buckets[key].setdefault(value, {})[obj['id']] = None
+            self._indexedValues[key][obj['id']] = value
+
+    def _RemoveKey(self, key, ID):
+        indexedValues = self._indexedValues[key]
+        if ID not in indexedValues:
+            return
+
+        value = indexedValues.pop(ID)
+        bucket = self._buckets[key][value]
+        bucket.pop(ID, None)
+        if not bucket:
+            del self._buckets[key][value]
+
@@ -0,0 +1,290 @@
+import time
+import threading
+from collections import defaultdict
+from sqlalchemy import event
+from dictabase.helpers import slowLog
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket has no upper bound
+BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+BUCKET_NAMES = ('<0.1ms', '<1ms', '<10ms', '<100ms', '<1s', '<10s', '>=10s')
+
+
+def _NewTimer():
+    return {
+        'count': 0,
+        'seconds': 0.0,
+        'maxSeconds': 0.0,
+        'statements': 0,  # SQL statements sent to the db
+        'histogram': [0] * len(BUCKET_NAMES),
+    }
+
+
+class _Operation:
+    # context manager timing one call, see Metrics.Operation()
+
+    def __init__(self, metrics, name, tableName):
+        self._metrics = metrics
+        self.name = name
+        self.tableName = tableName
+        self.statements = 0
+
+    def __enter__(self):
+        self._metrics._Stack().append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        stack = self._metrics._Stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self._metrics._Record(self, seconds)
+
+
+class _NoOperation:
+    # used while metrics are off, so that timing a call costs next to nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_noOperation = _NoOperation()
+
+
+class TimedLock:
+    '''
+    Works like the lock it wraps, and counts how long threads have waited for it while metrics are on.
+    Taking a free lock costs one extra call.
+    '''
+
+    def __init__(self, lock, name, metrics):
+        self._lock = lock
+        self._name = name
+        self._metrics = metrics
+
+    def acquire(self, blocking=True):
+        if self._lock.acquire(blocking=False):
+            return True
+        if not blocking:
+            return False
+
+        start = time.perf_counter()
+        self._lock.acquire()
+        if self._metrics.enabled:
+            self._metrics.AddLockWait(self._name, time.perf_counter() - start)
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+class Metrics:
+    # counters and latency histograms of the DatabaseWorker, off by default.
+    # While off, the only cost is checking self.enabled, and no SQL event listeners are registered.
+
+    def __init__(self):
+        self.enabled = False
+        self.slowSeconds = None  # log operations that take longer than this
+        self._engines = []  # the engines of every DatabaseWorker
+        self._listening = False
+        self._hooks = []  # functions called after every SQL statement
+        self._local = threading.local()  # .stack is the list of the _Operations this thread is in
+        self._lock = threading.Lock()
+        self.Reset()
+
+    def Reset(self):
+        with self._lock:
+            self._timers = defaultdict(_NewTimer)  # {(operation name, tableName): timer}
+            self._counters = defaultdict(int)  # {name: int}
+            self._keyTimes = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})  # {(LoadKey/DumpKey, tableName): {}}
+            self._sql = {'statements': 0, 'seconds': 0.0}
+
+    def SetEnabled(self, enabled, slowSeconds=None):
+        self.enabled = enabled
+        self.slowSeconds = slowSeconds
+        self._UpdateListeners()
+
+    def AddEngine(self, engine, replaces=None):
+        # called when a DatabaseWorker registers a db, replaces is the engine of the db it used before
+        if self._listening:
+            self._Unlisten()
+        if replaces in self._engines:
+            self._engines.remove(replaces)
+        self._engines.append(engine)
+        self._UpdateListeners()
+
+    def AddSQLHook(self, hook):
+        self._hooks.append(hook)
+        self._UpdateListeners()
+
+    def RemoveSQLHook(self, hook):
+        self._hooks.remove(hook)
+        self._UpdateListeners()
+
+    def _UpdateListeners(self):
+        wanted = self.enabled or bool(self._hooks)
+        if wanted and not self._listening:
+            for engine in self._engines:
+                event.listen(engine, 'before_cursor_execute', self._BeforeExecute)
+                event.listen(engine, 'after_cursor_execute', self._AfterExecute)
+            self._listening = True
+        elif not wanted and self._listening:
+            self._Unlisten()
+
+    def _Unlisten(self):
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute', self._BeforeExecute)
+            event.remove(engine, 'after_cursor_execute', self._AfterExecute)
+        self._listening = False
+
+    def _BeforeExecute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('dictabaseStart', []).append(time.perf_counter())
+
+    def _AfterExecute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('dictabaseStart')
+        seconds = time.perf_counter() - starts.pop() if starts else 0.0
+        stack = self._Stack()
+        operation = stack[-1] if stack else None
+
+        if self.enabled:
+            if operation is not None:
+                operation.statements += 1
+            with self._lock:
+                self._sql['statements'] += 1
+                self._sql['seconds'] += seconds
+
+        for hook in list(self._hooks):
+            hook(statement, parameters, seconds, operation.name if operation is not None else None)
+
+    def _Stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def TimedIter(self, name, cls, iterable):
+        '''
+        Same as Operation() for a generator like FindAll(). Only the time spent getting the next item is counted,
+        not the time the caller spends between items.
+        '''
+        if not self.enabled:
+            return iterable
+        return self._TimedIter(_Operation(self, name, cls.__name__ if cls is not None else None), iter(iterable))
+
+    def _TimedIter(self, operation, iterator):
+        seconds = 0.0
+        try:
+            while True:
+                stack = self._Stack()  # the caller can move on to another thread between items
+                stack.append(operation)
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                    stack.remove(operation)
+                yield item
+        finally:
+            iterator.close()
+            self._Record(operation, seconds)
+
+    def Operation(self, name, cls=None):
+        '''
+        Times a call to the DatabaseWorker, use it like:
+
+            with metrics.Operation('FindOne', cls):
+                ...
+
+        The SQL statements sent while it runs are counted for it, unless a nested Operation() sent them.
+        '''
+        if not self.enabled:
+            return _noOperation
+        return _Operation(self, name, cls.__name__ if cls is not None else None)
+
+    def _Record(self, operation, seconds):
+        bucket = 0
+        while bucket < len(BUCKETS) and seconds >= BUCKETS[bucket]:
+            bucket += 1
+
+        with self._lock:
+            timer = self._timers[(operation.name, operation.tableName)]
+            timer['count'] += 1
+            timer['seconds'] += seconds
+            timer['maxSeconds'] = max(timer['maxSeconds'], seconds)
+            timer['statements'] += operation.statements
+            timer['histogram'][bucket] += 1
+
+        if self.slowSeconds is not None and seconds >= self.slowSeconds:
+            slowLog.warning(
+                'slow %s(%s) took %.3f seconds and %s SQL statements',
+                operation.name, operation.tableName or '', seconds, operation.statements,
+            )
+
+    def Count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self._counters[name] += n
+
+    def AddLockWait(self, name, seconds):
+        with self._lock:
+            self._counters[name + 'Waits'] += 1
+            self._counters[name + 'WaitSeconds'] += seconds
+
+    def AddKeyTime(self, method, cls, calls, seconds):
+        # method is 'LoadKey' or 'DumpKey'
+        with self._lock:
+            times = self._keyTimes[(method, cls.__name__)]
+            times['calls'] += calls
+            times['seconds'] += seconds
+
+    def Snapshot(self):
+        '''
+        :return: dict, see dictabase.Stats()
+        '''
+        with self._lock:
+            operations = {}
+            tables = defaultdict(dict)
+            for (name, tableName), timer in self._timers.items():
+                total = operations.setdefault(name, _NewTimer())
+                total['count'] += timer['count']
+                total['seconds'] += timer['seconds']
+                total['maxSeconds'] = max(total['maxSeconds'], timer['maxSeconds'])
+                total['statements'] += timer['statements']
+                total['histogram'] = [a + b for a, b in zip(total['histogram'], timer['histogram'])]
+                if tableName is not None:
+                    tables[tableName][name] = _Report(timer)
+
+            keyTimes = defaultdict(dict)
+            for (method, tableName), times in self._keyTimes.items():
+                keyTimes[method][tableName] = dict(times)
+
+            return {
+                'enabled': self.enabled,
+                'operations': {name: _Report(timer) for name, timer in operations.items()},
+                'tables': dict(tables),
+                'sql': dict(self._sql),
+                'counters': dict(self._counters),
+                'loadKey': keyTimes.get('LoadKey', {}),
+                'dumpKey': keyTimes.get('DumpKey', {}),
+            }
+
+
+def _Report(timer):
+    ret = dict(timer)
+    ret['histogram'] = dict(zip(BUCKET_NAMES, timer['histogram']))
+    return ret
+
+
+metrics = Metrics()  # shared by the DatabaseWorker and BaseTable
@@ -0,0 +1,213 @@
+import re
+import operator
+from sqlalchemy import and_, true, false
+from dictabase.helpers import IsHashable
+
+# the filters of FindOne()/FindAll()/DeleteWhere()/UpdateWhere() look like:
+#   FindAll(UserClass, name='Grant', age={'gte': 18, 'lt': 65}, country=['NL', 'BE'], email={'isnull': False})
+# a plain value means ==, a list/tuple/set means 'in', and a dict holds {operator: value}.
+# Clause() turns them into SQL and Matcher() checks them against in-use objs, both give the same answer.
+
+OPERATORS = {  # {name: canonical name}
+    'eq': 'eq', '=': 'eq', '==': 'eq', 'is': 'eq',
+    'ne': 'ne', '!=': 'ne', '<>': 'ne', 'not': 'ne',
+    'gt': 'gt', '>': 'gt',
+    'gte': 'gte', '>=': 'gte',
+    'lt': 'lt', '<': 'lt',
+    'lte': 'lte', '<=': 'lte',
+    'in': 'in',
+    'notin': 'notin',
+    'between': 'between', '..': 'between',
+    'like': 'like',
+    'notlike': 'notlike',
+    'ilike': 'ilike',
+    'notilike': 'notilike',
+    'startswith': 'startswith',
+    'endswith': 'endswith',
+    'contains': 'contains',
+    'isnull': 'isnull',
+}
+
+_COMPARISONS = {
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+
+
+def IsPlainValue(value):
+    # True if value means key == value, so it can be looked up in a hash index
+    return value is not None and not isinstance(value, (dict, list, tuple, set, frozenset)) and IsHashable(value)
+
+
+def _Terms(filters):
+    # yields (key, canonical operator, value)
+    for key, value in filters.items():
+        if isinstance(value, dict):
+            for op, opValue in value.items():
+                if op not in OPERATORS:
+                    raise ValueError('Unknown operator "{}" for key "{}", use one of {}'.format(
+                        op, key, sorted(OPERATORS)))
+                yield key, OPERATORS[op], opValue
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            yield key, 'in', value
+        else:
+            yield key, 'eq', value
+
+
+def Clause(tbl, filters, clauses=(), dumpKey=None):
+    '''
+    :param tbl: dataset.Table, the table must exist
+    :param filters: dict like the kwargs of FindAll()
+    :param clauses: more sqlalchemy clauses that must all be true
+    :param dumpKey: function(key, value) -> dumpedValue, usually BaseTable.DumpKey.
+        The values that are compared with the column are dumped first, like the values in the db.
+    :return: sqlalchemy clause
+    '''
+    clauses = list(clauses)
+    for key, op, value in _Terms(filters):
+        if not tbl.has_column(key):
+            # every row has NULL for a column that does not exist
+            clauses.append(true() if _Test(op, value, tbl.db.engine.dialect.name)(None) else false())
+            continue
+
+        if dumpKey is not None and op in _DUMPED:
+            value = _Dump(dumpKey, key, op, value)
+
+        column = tbl.table.c[key]
+        if op == 'eq':
+            clauses.append(column.is_(None) if value is None else column == value)
+        elif op == 'ne':
+            clauses.append(column.isnot(None) if value is None else column != value)
+        elif op in _COMPARISONS:
+            clauses.append(_COMPARISONS[op](column, value))
+        elif op == 'in':
+            clauses.append(column.in_(list(value)) if value else false())
+        elif op == 'notin':
+            clauses.append(column.notin_(list(value)) if value else column.isnot(None))
+        elif op == 'between':
+            start, end = value
+            clauses.append(column.between(start, end))
+        elif op == 'like':
+            clauses.append(column.like(value))
+        elif op == 'notlike':
+            clauses.append(column.notlike(value))
+        elif op == 'ilike':
+            clauses.append(column.ilike(value))
+        elif op == 'notilike':
+            clauses.append(column.notilike(value))
+        elif op == 'startswith':
+            clauses.append(column.startswith(value, autoescape=True))
+        elif op == 'endswith':
+            clauses.append(column.endswith(value, autoescape=True))
+        elif op == 'contains':
+            clauses.append(column.contains(value, autoescape=True))
+        elif op == 'isnull':
+            clauses.append(column.is_(None) if value else column.isnot(None))
+
+    return and_(*clauses)
+
+
+_DUMPED = ('eq', 'ne', 'gt', 'gte', 'lt', 'lte', 'in', 'notin', 'between')  # ops that compare with a stored value
+
+
+def _Dump(dumpKey, key, op, value):
+    if op in ('in', 'notin', 'between'):
+        return [None if x is None else dumpKey(key, x) for x in value]
+    return None if value is None else dumpKey(key, value)
+
+
+def Matcher(filters, dialect='sqlite'):
+    '''
+    Compiles filters into a function, so they can be checked against many objs quickly.
+
+    :param filters: dict like the kwargs of FindAll()
+    :param dialect: str - the name of the sqlalchemy dialect, LIKE ignores case on sqlite
+    :return: function(obj) -> bool, True if obj matches filters like its row would in the db
+    '''
+    tests = [(key, _Test(op, value, dialect)) for key, op, value in _Terms(filters)]
+
+    def Match(obj):
+        for key, test in tests:
+            if not test(obj.get(key)):
+                return False
+        return True
+
+    return Match
+
+
+def _Test(op, value, dialect):
+    # returns a function(v) -> bool that works like the SQL for op, where v is None for NULL.
+    # In SQL a comparison with NULL is never true, except IS NULL
+    if op == 'eq':
+        if value is None:
+            return lambda v: v is None
+        return lambda v: v is not None and v == value
+
+    if op == 'ne':
+        if value is None:
+            return lambda v: v is not None
+        return lambda v: v is not None and v != value
+
+    if op in _COMPARISONS:
+        return _Compare(_COMPARISONS[op], value)
+
+    if op == 'in':
+        values = [x for x in value if x is not None]
+        return lambda v: v is not None and v in values
+
+    if op == 'notin':
+        if any(x is None for x in value):
+            return lambda v: False  # x NOT IN (..., NULL) is never true
+        values = list(value)
+        return lambda v: v is not None and v not in values
+
+    if op == 'between':
+        start, end = value
+        lower, upper = _Compare(operator.ge, start), _Compare(operator.le, end)
+        return lambda v: lower(v) and upper(v)
+
+    if op == 'isnull':
+        if value:
+            return lambda v: v is None
+        return lambda v: v is not None
+
+    # sqlite LIKE ignores the case of ASCII letters, ILIKE compares lower() which is also ASCII only on sqlite
+    flags = re.DOTALL | (re.ASCII if dialect == 'sqlite' else 0)
+    ignoreCase = re.IGNORECASE if dialect == 'sqlite' else 0
+
+    if op in ('like', 'notlike'):
+        regex = re.compile(_LikeToRegex(value), flags | ignoreCase)
+    elif op in ('ilike', 'notilike'):
+        regex = re.compile(_LikeToRegex(value), flags | re.IGNORECASE)
+    elif op == 'startswith':
+        regex = re.compile(re.escape(value) + '.*', flags | ignoreCase)
+    elif op == 'endswith':
+        regex = re.compile('.*' + re.escape(value), flags | ignoreCase)
+    else:  # contains
+        regex = re.compile('.*' + re.escape(value) + '.*', flags | ignoreCase)
+
+    if op.startswith('not'):
+        return lambda v: v is not None and regex.fullmatch(str(v)) is None
+    return lambda v: v is not None and regex.fullmatch(str(v)) is not None
+
+
+def _Compare(compare, value):
+    def Test(v):
+        if v is None or value is None:
+            return False
+        try:
+            return compare(v, value)
+        except TypeError:
+            return False  # for example str > int
+
+    return Test
+
+
+def _LikeToRegex(pattern):
+    # % matches any number of characters, _ matches one character
+    return ''.join(
+        '.*' if char == '%' else '.' if char == '_' else re.escape(char)
+        for char in pattern
+    )
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+
+def FreezeKwargs(kwargs):
+    '''
+    :param kwargs: dict like the kwargs of FindAll()
+    :return: a hashable key that is equal for equal kwargs, or None if a value cannot be used in a key
+    '''
+    try:
+        ret = _Freeze(kwargs)
+        hash(ret)
+        return ret
+    except TypeError:
+        return None
+
+
+def _Freeze(value):
+    if isinstance(value, dict):
+        return ('dict', frozenset((k, _Freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return ('set', frozenset(_Freeze(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        return ('list', tuple(_Freeze(v) for v in value))
+    return (type(value), value)  # so that 1, 1.0 and True are different keys
+
+
+class QueryCache:
+    # remembers the rows FindAll() found for one class, keyed by its kwargs.
+    # Every write to the table clears it, entries also expire after maxAge seconds because other processes
+    # can write to the db too. Not thread safe, the DatabaseWorker holds its _workerLock while using it.
+
+    def __init__(self, maxEntries, maxAge, maxRows):
+        self.maxEntries = maxEntries
+        self.maxAge = maxAge
+        self.maxRows = maxRows  # larger results are not kept
+
+        # bumped by every Invalidate(), a result read from the db before that is not stored
+        self.version = 0
+        self._entries = OrderedDict()  # {key: (expires, rows)}, least recently used first
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,  # entries that were too old when they were looked up
+            'evictions': 0,  # entries dropped to stay within maxEntries
+            'invalidations': 0,  # writes that cleared entries
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def Get(self, key):
+        '''
+        :return: list of dict rows, or None if there is no entry for key
+        '''
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, rows = entry
+            if time.monotonic() < expires:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return rows
+
+            del self._entries[key]
+            self.stats['expired'] += 1
+
+        self.stats['misses'] += 1
+        return None
+
+    def Put(self, key, rows, version):
+        '''
+        :param version: self.version from before the rows were read from the db
+        '''
+        if version != self.version or len(rows) > self.maxRows:
+            return
+
+        self._entries[key] = (time.monotonic() + self.maxAge, rows)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def Invalidate(self):
+        # call this after a write to the table has been committed
+        self.version += 1
+        if self._entries:
+            self._entries.clear()
+            self.stats['invalidations'] += 1
@@ -0,0 +1,378 @@
+import zlib
+import heapq
+import queue
+import threading
+import itertools
+from dictabase.database_worker import DatabaseWorker
+from dictabase.query import IsPlainValue
+from dictabase.helpers import apiLog
+
+
+def ShardIndex(value, numShards):
+    '''
+    :return: int - the shard that holds the rows with this shard key value.
+        The same in every process, unlike hash() of a str.
+    '''
+    if isinstance(value, bool) or (isinstance(value, float) and value.is_integer()):
+        value = int(value)  # SQL finds 1, 1.0 and True with the same filter, so they must be in the same shard
+    return zlib.crc32(repr(value).encode()) % numShards
+
+
+class Router:
+    # decides which DatabaseWorker holds the table of a class. Every DatabaseWorker has its own db, connections
+    # and write lock, so classes in different dbs are written in parallel.
+    # Classes that are not routed use the default DatabaseWorker, the one RegisterDBURI() sets up.
+    # Has the same methods as DatabaseWorker, the ones that take a cls are sent to the worker(s) of that cls.
+
+    def __init__(self, default):
+        self.default = default
+        self._workers = {}  # {dburi: DatabaseWorker}
+        self._routes = {}  # {cls: DatabaseWorker}
+        self._shards = {}  # {cls: (shardKey, [DatabaseWorker])}
+
+    def _Worker(self, dburi):
+        if dburi == self.default._dburi:
+            return self.default
+
+        worker = self._workers.get(dburi)
+        if worker is None:
+            worker = self._workers[dburi] = DatabaseWorker()
+            worker.RegisterDBURI(dburi)
+        return worker
+
+    def Route(self, cls, dburi):
+        apiLog.debug('Route(%s, %s)', cls, dburi)
+        self._shards.pop(cls, None)
+        self._routes[cls] = self._Worker(dburi)
+
+    def Shard(self, cls, shardKey, dburis):
+        apiLog.debug('Shard(%s, %s, %s)', cls, shardKey, dburis)
+        self._routes.pop(cls, None)
+        self._shards[cls] = (shardKey, [self._Worker(dburi) for dburi in dburis])
+
+    def AllWorkers(self):
+        # every registered DatabaseWorker, always in the same order
+        ret = [self.default] if self.default._db is not None else []
+        ret.extend(worker for worker in self._workers.values() if worker is not self.default)
+        return ret
+
+    def Workers(self, cls, kwargs=None):
+        '''
+        :param kwargs: filters, if they pick one value for the shard key only that shard is returned
+        :return: list of the DatabaseWorkers that can hold rows of cls
+        '''
+        shard = self._shards.get(cls)
+        if shard is None:
+            return [self._routes.get(cls, self.default)]
+
+        shardKey, workers = shard
+        if kwargs is not None and shardKey in kwargs and IsPlainValue(kwargs[shardKey]):
+            return [workers[ShardIndex(kwargs[shardKey], len(workers))]]
+        return workers
+
+    def _ShardOf(self, cls, row):
+        shardKey, workers = self._shards[cls]
+        if row.get(shardKey) is None:
+            raise ValueError('"{}" is sharded by "{}", every new row needs a value for it.'.format(
+                cls.__name__, shardKey))
+        return workers[ShardIndex(row[shardKey], len(workers))]
+
+    def Insert(self, cls, **kwargs):
+        if cls in self._shards:
+            return self._ShardOf(cls, kwargs).Insert(cls, **kwargs)
+        return self.Workers(cls)[0].Insert(cls, **kwargs)
+
+    def InsertMany(self, cls, rows, chunkSize=1000, keepInUse=False):
+        if cls not in self._shards:
+            return self.Workers(cls)[0].InsertMany(cls, rows, chunkSize=chunkSize, keepInUse=keepInUse)
+
+        # each chunk is split up by shard, the results are put back in the order of rows
+        rows = iter(rows)
+        ret = []
+        while True:
+            chunk = list(itertools.islice(rows, chunkSize))
+            if not chunk:
+                break
+
+            byShard = {}  # {worker: [(index in chunk, row)]}
+            for index, row in enumerate(chunk):
+                byShard.setdefault(self._ShardOf(cls, row), []).append((index, row))
+
+            inserted = [None] * len(chunk)
+            for worker, indexedRows in byShard.items():
+                results = worker.InsertMany(cls, [row for _, row in indexedRows], chunkSize, keepInUse)
+                for (index, _), result in zip(indexedRows, results):
+                    inserted[index] = result
+            ret.extend(inserted)
+        return ret
+
+    def FindOne(self, cls, kwargs):
+        for worker in self.Workers(cls, kwargs):
+            found = worker.FindOne(cls, dict(kwargs))
+            if found is not None:
+                return found
+        return None
+
+    def FindAll(self, cls, kwargs):
+        workers = self.Workers(cls, kwargs)
+        if len(workers) == 1:
+            return workers[0].FindAll(cls, kwargs)
+        return _MergedFindAll(workers, cls, kwargs)
+
+    def FindColumns(self, cls, columns, filters, orderBy=None, reverse=False, limit=None, offset=0, batchSize=10000):
+        workers = self.Workers(cls, filters)
+        if len(workers) == 1:
+            return workers[0].FindColumns(cls, columns, filters, orderBy, reverse, limit, offset, batchSize)
+        return _MergedFindColumns(workers, cls, columns, filters, orderBy, reverse, limit, offset, batchSize)
+
+    def Delete(self, obj):
+        # the obj knows which db its row is in
+        (obj._worker or self.Workers(type(obj))[0]).Delete(obj)
+
+    def DeleteWhere(self, cls, filters):
+        return sum(worker.DeleteWhere(cls, filters) for worker in self.Workers(cls, filters))
+
+    def UpdateWhere(self, cls, filters, values):
+        shard = self._shards.get(cls)
+        if shard is not None and shard[0] in values:
+            raise ValueError('UpdateWhere() cannot change the shard key "{}", it decides which db holds the row.'.format(
+                shard[0]))
+        return sum(worker.UpdateWhere(cls, filters, values) for worker in self.Workers(cls, filters))
+
+    def Aggregate(self, cls, function, key, filters, groupBy=None):
+        results = [worker.Aggregate(cls, function, key, filters, groupBy=groupBy) for worker in self.Workers(cls, filters)]
+        if len(results) == 1:
+            return results[0]
+        if groupBy is None:
+            return _Combine(function, results)
+
+        groups = {}
+        for result in results:
+            for groupValue, value in result.items():
+                groups.setdefault(groupValue, []).append(value)
+        return {groupValue: _Combine(function, values) for groupValue, values in groups.items()}
+
+    def Exists(self, cls, filters):
+        return any(worker.Exists(cls, filters) for worker in self.Workers(cls, filters))
+
+    def Drop(self, cls):
+        for worker in self.Workers(cls):
+            worker.Drop(cls)
+
+    def EnsureIndexes(self, cls):
+        for worker in self.Workers(cls):
+            worker.EnsureIndexes(cls)
+
+    def Flush(self, cls=None):
+        for worker in self.Workers(cls) if cls is not None else self.AllWorkers():
+            worker.Flush(cls)
+
+    def BeginTransaction(self):
+        # begins on every db, always in the same order so two threads cant each hold the write lock the other needs
+        begun = []
+        try:
+            for worker in self.AllWorkers():
+                worker.BeginTransaction()
+                begun.append(worker)
+        except Exception:
+            for worker in reversed(begun):
+                worker.RollbackTransaction()
+            raise
+
+    def CommitTransaction(self):
+        # each db commits on its own, if one of them fails the ones after it are rolled back
+        workers = self.AllWorkers()
+        for index, worker in enumerate(workers):
+            try:
+                worker.CommitTransaction()  # rolls itself back if it fails
+            except Exception:
+                for other in workers[index + 1:]:
+                    other.RollbackTransaction()
+                raise
+
+    def RollbackTransaction(self):
+        error = None
+        for worker in self.AllWorkers():
+            try:
+                worker.RollbackTransaction()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+
+    def SetFlushPolicy(self, maxPending=None, maxAge=None, background=None):
+        for worker in self.AllWorkers():
+            worker.SetFlushPolicy(maxPending=maxPending, maxAge=maxAge, background=background)
+
+    def SetCacheSize(self, cacheSize):
+        for worker in self.AllWorkers():
+            worker.SetCacheSize(cacheSize)
+
+    def SetQueryCache(self, cls, maxEntries=100, maxAge=60, maxRows=1000):
+        for worker in self.Workers(cls):
+            worker.SetQueryCache(cls, maxEntries=maxEntries, maxAge=maxAge, maxRows=maxRows)
+
+    def FlushStats(self):
+        return _SumStats([worker.FlushStats() for worker in self.AllWorkers()])
+
+    def CacheStats(self):
+        return _SumStats([worker.CacheStats() for worker in self.AllWorkers()])
+
+    def QueryCacheStats(self):
+        return _SumStats([worker.QueryCacheStats() for worker in self.AllWorkers()])
+
+
+def _Combine(function, values):
+    # combines the result of an aggregate from each shard
+    values = [value for value in values if value is not None]
+    if function == 'count':
+        return sum(values)
+    if not values:
+        return None
+    if function == 'sum':
+        return sum(values)
+    return min(values) if function == 'min' else max(values)
+
+
+_MAX_STATS = ('pendingSeconds', 'lastFlushSeconds', 'maxFlushSeconds', 'cacheSize')  # the largest, not the total
+
+
+def _SumStats(statsList):
+    if len(statsList) == 1:
+        return statsList[0]
+
+    ret = {}
+    for stats in statsList:
+        for key, value in stats.items():
+            if key not in ret:
+                ret[key] = value
+            elif key in _MAX_STATS:
+                ret[key] = max(ret[key], value)
+            else:
+                ret[key] += value
+    return ret
+
+
+def _SortKey(value):
+    # sorts like sqlite does, NULL comes before any value
+    return (value is not None, value)
+
+
+def _MergedFindAll(workers, cls, kwargs):
+    '''
+    FindAll() on every shard at the same time, merged into one stream.
+    With _orderBy the shards are merged in that order, otherwise all rows of the first shard come first.
+    '''
+    kwargs = dict(kwargs)
+    orderBy = kwargs.get('_orderBy', None)
+    reverse = kwargs.get('_reverse', False)
+    limit = kwargs.pop('_limit', None)
+    offset = kwargs.pop('_offset', 0)
+    if limit is not None:
+        kwargs['_limit'] = offset + limit  # any shard could have all of the first rows
+
+    if any(worker._InTransaction() for worker in workers):
+        # this thread holds the write lock of every db and only its own connections see the uncommitted rows,
+        # so the shards are searched one after the other on this thread
+        streams = [_SerialStream(worker.FindAll(cls, dict(kwargs))) for worker in workers]
+    else:
+        streams = [_ShardStream(worker, cls, dict(kwargs)) for worker in workers]
+    try:
+        if orderBy is None:
+            merged = itertools.chain.from_iterable(streams)
+        else:
+            # same order as each shard, by the column and then by id
+            merged = heapq.merge(*streams, key=lambda obj: (_SortKey(obj.get(orderBy)), obj.get('id')), reverse=reverse)
+
+        for obj in itertools.islice(merged, offset, None if limit is None else offset + limit):
+            yield obj
+    finally:
+        for stream in streams:
+            stream.Close()
+
+
+def _MergedFindColumns(workers, cls, columns, filters, orderBy, reverse, limit, offset, batchSize):
+    # same as _MergedFindAll(), for the batches of tuples of DatabaseWorker.FindColumns()
+    shardLimit = None if limit is None else offset + limit
+    shards = [
+        itertools.chain.from_iterable(worker.FindColumns(cls, columns, filters, orderBy, reverse, shardLimit, 0, batchSize))
+        for worker in workers
+    ]
+    if orderBy is None:
+        merged = itertools.chain.from_iterable(shards)
+    elif orderBy in columns:
+        index = columns.index(orderBy)
+        merged = heapq.merge(*shards, key=lambda row: _SortKey(row[index]), reverse=reverse)
+    else:
+        raise ValueError('_orderBy "{}" must be one of the columns when "{}" is sharded.'.format(orderBy, cls.__name__))
+
+    rows = itertools.islice(merged, offset, None if limit is None else offset + limit)
+    while True:
+        batch = list(itertools.islice(rows, batchSize))
+        if not batch:
+            return
+        yield batch
+
+
+class _SerialStream:
+    # a FindAll() generator with the Close() of _ShardStream
+
+    def __init__(self, found):
+        self._found = found
+
+    def __iter__(self):
+        return iter(self._found)
+
+    def Close(self):
+        self._found.close()
+
+
+class _ShardStream:
+    # runs FindAll() on one shard in a thread of its own, a db cursor must be used by the thread that opened it.
+    # At most 2 batches are fetched ahead of the caller.
+
+    def __init__(self, worker, cls, kwargs):
+        self._batchSize = kwargs.get('_batchSize', 1000)
+        self._queue = queue.Queue(maxsize=2)  # (batch, exception), an empty batch when there are no more rows
+        self._stop = threading.Event()
+        threading.Thread(
+            target=self._Fetch,
+            args=(worker, cls, kwargs),
+            name='dictabase-shard',
+            daemon=True,
+        ).start()
+
+    def _Fetch(self, worker, cls, kwargs):
+        found = worker.FindAll(cls, kwargs)
+        try:
+            while not self._stop.is_set():
+                batch = list(itertools.islice(found, self._batchSize))
+                self._Put((batch, None))
+                if not batch:
+                    return
+        except BaseException as e:
+            self._Put((None, e))
+        finally:
+            found.close()
+
+    def _Put(self, item):
+        # dont block forever if the caller has stopped reading
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        while True:
+            batch, exception = self._queue.get()
+            if exception is not None:
+                raise exception
+            if not batch:
+                return
+            for obj in batch:
+                yield obj
+
+    def Close(self):
+        self._stop.set()
@@ -0,0 +1,79 @@
+class RowLayout:
+    # the columns of the rows of one query, shared by all of its Rows
+
+    __slots__ = ('keys', 'indexes')
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.indexes = {key: index for index, key in enumerate(self.keys)}  # {key: index in Row._values}
+
+
+class Row:
+    '''
+    A read-only row returned by FindAll(cls, _readonly=True).
+    Reads like a BaseTable obj, row['name'] or row.name, but it cannot be changed, is never written back to the db,
+    and is not kept in use. Much smaller and faster to create than a BaseTable obj.
+    '''
+
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, layout, values):
+        object.__setattr__(self, '_layout', layout)
+        object.__setattr__(self, '_values', values)
+
+    def __getitem__(self, key):
+        index = self._layout.indexes.get(key)
+        return None if index is None else self._values[index]  # like BaseTable, a missing key is None
+
+    def __getattr__(self, key):
+        # only called for names that are not slots or methods
+        index = self._layout.indexes.get(key)
+        if index is None:
+            raise AttributeError(key)
+        return self._values[index]
+
+    def get(self, key, default=None):
+        index = self._layout.indexes.get(key)
+        return default if index is None else self._values[index]
+
+    def __contains__(self, key):
+        return key in self._layout.indexes
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return self._layout.keys
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._layout.keys, self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self._layout.keys == other._layout.keys and self._values == other._values
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    __hash__ = None  # the values can be lists and dicts
+
+    def __setitem__(self, key, value):
+        raise TypeError('Row is read-only, use FindAll() without _readonly=True to change objects.')
+
+    def __setattr__(self, key, value):
+        self.__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.__setitem__(key, None)
+
+    def __delattr__(self, key):
+        self.__setitem__(key, None)
+
+    def __repr__(self):
+        return '<Row: {}>'.format(', '.join('{}={!r}'.format(key, value) for key, value in self.items()))
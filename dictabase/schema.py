@@ -0,0 +1,89 @@
+from sqlalchemy import bindparam
+from dataset.util import pad_chunk_columns
+from dictabase.helpers import sqlLog
+
+
+class TableSchema:
+    # what is known about the table of one class: which keys have a column, and the INSERT/UPDATE statements
+    # compiled for it. dataset would inspect the columns and compile the statement again for every write.
+    # Only used while holding the DatabaseWorker's _writeLock, a rollback throws it away (see _Database).
+
+    def __init__(self, db, tableName):
+        self.db = db
+        self.table = db[tableName]  # dataset.Table
+        self._names = {}  # {key: column name}, dataset matches keys with columns without looking at case
+        self._compiled = {}  # {(statement kind, keys): sqlalchemy Compiled}
+        self._synced = False  # True once the table is known to exist
+
+    def EnsureColumns(self, rows):
+        '''
+        Creates the table and the columns that rows need and do not exist yet.
+        The type of a new column is guessed from the first value that is not None.
+
+        :param rows: list of dicts like {key: dumpedValue}
+        '''
+        examples = {}
+        for row in rows:
+            for key, value in row.items():
+                if key not in self._names and examples.get(key) is None:
+                    examples[key] = value
+        if not examples and self._synced:
+            return
+
+        sqlLog.debug('EnsureColumns(%s, %s)', self.table.name, list(examples))
+        self.table._sync_columns(examples, True)  # ALTER TABLE only for the keys that are really new
+        for key in examples:
+            self._names[key] = self.table._get_column_name(key)
+        self._synced = True
+
+    def _Columns(self, row):
+        # row with its keys renamed to the column names, if any of them differ
+        if all(self._names[key] == key for key in row):
+            return row
+        return {self._names[key]: value for key, value in row.items()}
+
+    def _Compile(self, kind, keys):
+        compiled = self._compiled.get((kind, keys))
+        if compiled is None:
+            sqlTable = self.table.table
+            if kind == 'update':
+                statement = sqlTable.update().where(sqlTable.c.id == bindparam('_id')).values(
+                    {key: bindparam(key) for key in keys}
+                )
+            else:
+                statement = sqlTable.insert()
+            compiled = self._compiled[(kind, keys)] = statement.compile(
+                dialect=self.db.engine.dialect,
+                column_keys=list(keys),
+                inline=kind == 'insertMany',  # executemany() cant return the new primary keys
+            )
+        return compiled
+
+    def Insert(self, row):
+        '''
+        :param row: dict like {key: dumpedValue}
+        :return: int - id of the new row
+        '''
+        self.EnsureColumns([row])
+        row = self._Columns(row)
+        result = self.db.executable.execute(self._Compile('insert', tuple(sorted(row))), row)
+        return result.inserted_primary_key[0]
+
+    def InsertMany(self, rows):
+        # one executemany() INSERT, rows that miss some of the keys get NULL for them
+        self.EnsureColumns(rows)
+        rows = [self._Columns(row) for row in rows]
+        keys = sorted({key for row in rows for key in row})
+        self.db.executable.execute(self._Compile('insertMany', tuple(keys)), pad_chunk_columns(rows, keys))
+
+    def UpdateMany(self, keys, rows):
+        '''
+        One executemany() UPDATE of rows that all set the same keys.
+
+        :param keys: tuple of the keys every row sets
+        :param rows: list of dicts like {'id': id, key: dumpedValue, ...}
+        '''
+        self.EnsureColumns(rows)
+        params = [dict(self._Columns({key: row[key] for key in keys}), _id=row['id']) for row in rows]
+        columns = tuple(sorted(self._names[key] for key in keys))
+        self.db.executable.execute(self._Compile('update', columns), params)
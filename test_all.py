@@ -1,6 +1,7 @@
 import json
 import time
 import random
+import pytest
 from dictabase import (
     RegisterDBURI,
     BaseTable,
@@ -461,3 +462,1435 @@ def test_Default():
 
     assert foundD['one'] == '1'
     assert foundD['nah'] is None
+
+
+def CountWrites(func):
+    # returns the number of INSERT/UPDATE statements sent to the db while func() runs
+    from sqlalchemy import event
+    from dictabase import _dbWorker
+
+    statements = []
+
+    def Listener(conn, cursor, statement, *a, **k):
+        if statement.startswith(('INSERT', 'UPDATE')):
+            statements.append(statement)
+
+    engine = _dbWorker._db.engine
+    event.listen(engine, 'before_cursor_execute', Listener)
+    try:
+        func()
+    finally:
+        event.remove(engine, 'before_cursor_execute', Listener)
+
+    print('CountWrites statements=', statements)
+    return statements
+
+
+def test_OnlyDirtyObjectsAreWritten():
+    class DirtyClass(BaseTable):
+        pass
+
+    Drop(DirtyClass, confirm=True)
+
+    objs = [New(DirtyClass, count=i, name='name{}'.format(i)) for i in range(50)]
+
+    def Change():
+        objs[7]['count'] = 777
+        assert len(list(FindAll(DirtyClass, count=777))) == 1
+
+    statements = CountWrites(Change)
+    assert len(statements) == 1
+    assert 'name' not in statements[0]  # only the changed column is written
+
+    # nothing has changed, nothing is written
+    statements = CountWrites(lambda: list(FindAll(DirtyClass)))
+    assert len(statements) == 0
+
+
+def test_MutableValueChangedInPlace():
+    class ListClass(BaseTable):
+        def DumpKey(self, key, value):
+            return json.dumps(value) if key == 'items' else value
+
+        def LoadKey(self, key, dbValue):
+            return json.loads(dbValue) if key == 'items' else dbValue
+
+    Drop(ListClass, confirm=True)
+
+    obj = New(ListClass, items=[])
+    obj['items'].append(1)
+    obj['items'].append(2)
+
+    statements = CountWrites(lambda: list(FindAll(ListClass)))
+    assert len(statements) == 1
+
+    from dictabase import _dbWorker
+    row = _dbWorker._db['ListClass'].find_one(id=obj['id'])
+    assert json.loads(row['items']) == [1, 2]
+
+
+def test_FlushWritesOneTransaction():
+    from sqlalchemy import event
+    from dictabase import _dbWorker, Flush
+
+    class BatchClass(BaseTable):
+        pass
+
+    Drop(BatchClass, confirm=True)
+
+    objs = [New(BatchClass, count=i) for i in range(20)]
+
+    commits = []
+
+    def OnCommit(conn):
+        commits.append(conn)
+
+    engine = _dbWorker._db.engine
+    event.listen(engine, 'commit', OnCommit)
+
+    def Change():
+        for obj in objs:
+            obj['count'] += 100
+        Flush()
+
+    try:
+        statements = CountWrites(Change)
+    finally:
+        event.remove(engine, 'commit', OnCommit)
+
+    assert len(statements) == 1  # executemany()
+    assert len(commits) == 1
+
+    rows = list(_dbWorker._db['BatchClass'].find(order_by='id'))
+    assert [row['count'] for row in rows] == list(range(100, 120))
+
+
+def test_ReadYourWrites():
+    from dictabase import SetFlushPolicy
+
+    class QueuedClass(BaseTable):
+        pass
+
+    Drop(QueuedClass, confirm=True)
+
+    SetFlushPolicy(maxPending=1000, maxAge=1000)
+    try:
+        obj = New(QueuedClass, name='before')
+        obj['name'] = 'after'
+        del obj  # the change is now waiting in the queue
+
+        assert FindOne(QueuedClass, name='before') is None
+        assert FindOne(QueuedClass, name='after') is not None
+        assert len(list(FindAll(QueuedClass, name='after'))) == 1
+    finally:
+        SetFlushPolicy(maxPending=1000, maxAge=1)
+
+
+def test_NewMany():
+    from dictabase import NewMany
+
+    class ManyClass(BaseTable):
+        def DumpKey(self, key, value):
+            return json.dumps(value) if key == 'tags' else value
+
+        def LoadKey(self, key, dbValue):
+            return json.loads(dbValue) if key == 'tags' else dbValue
+
+    Drop(ManyClass, confirm=True)
+
+    first = New(ManyClass, count=-1, tags=[])
+
+    rows = (dict(count=i, tags=['tag{}'.format(i)]) for i in range(250))
+    IDs = NewMany(ManyClass, rows, chunk_size=100)
+    assert len(IDs) == 250
+    assert IDs == list(range(first['id'] + 1, first['id'] + 251))
+
+    for i in (0, 99, 100, 249):
+        obj = FindOne(ManyClass, id=IDs[i])
+        assert obj['count'] == i
+        assert obj['tags'] == ['tag{}'.format(i)]
+
+    objs = NewMany(ManyClass, [dict(count=1000), dict(count=1001, extra='new column')], keepInUse=True)
+    assert objs[1]['extra'] == 'new column'
+    assert FindOne(ManyClass, count=1001) is objs[1]
+    assert len(list(FindAll(ManyClass))) == 253
+
+
+def test_InUseIndex():
+    from dictabase import _dbWorker
+
+    class IndexedUser(BaseTable):
+        def DumpKey(self, key, value):
+            return json.dumps(value) if key == 'tags' else value
+
+        def LoadKey(self, key, dbValue):
+            return json.loads(dbValue) if key == 'tags' else dbValue
+
+    Drop(IndexedUser, confirm=True)
+
+    users = [New(IndexedUser, email='user{}@website.com'.format(i), group=i % 3, tags=[i]) for i in range(100)]
+
+    assert FindOne(IndexedUser, email='user42@website.com') is users[42]
+    assert len(list(FindAll(IndexedUser, group=1))) == 33
+
+    # the index follows changes to the in-use objects
+    users[42]['email'] = 'changed@website.com'
+    assert FindOne(IndexedUser, email='changed@website.com') is users[42]
+    assert FindOne(IndexedUser, email='user42@website.com') is None
+
+    assert users[43].pop('email') == 'user43@website.com'
+    assert FindOne(IndexedUser, email='user43@website.com') is None
+    assert not _dbWorker._inUseIndex[IndexedUser]._GetBucket('email', 'user43@website.com')
+
+    users[44].update(group=1)
+    assert len(list(FindAll(IndexedUser, group=1))) == 34
+
+    # unhashable values are still found, a list by itself would mean 'in'
+    assert FindOne(IndexedUser, tags={'eq': [7]}) is users[7]
+    assert FindOne(IndexedUser, tags={'eq': [8]}, group=2) is users[8]
+
+
+def test_DeclaredIndexes():
+    import sqlalchemy.exc
+    from dictabase import _dbWorker, EnsureIndexes
+
+    class IndexedAccount(BaseTable):
+        __indexes__ = [('owner', 'created')]
+        __uniqueIndexes__ = [('email',)]
+
+    Drop(IndexedAccount, confirm=True)
+
+    for i in range(10):
+        New(IndexedAccount, email='account{}@website.com'.format(i), owner=i % 2, created=i)
+    EnsureIndexes(IndexedAccount)
+
+    def QueryPlan(where):
+        rows = _dbWorker._db.query('EXPLAIN QUERY PLAN SELECT * FROM IndexedAccount WHERE {}'.format(where))
+        return ' '.join(row['detail'] for row in rows)
+
+    assert 'USING INDEX' in QueryPlan("email = 'account3@website.com'")
+    assert 'USING INDEX' in QueryPlan('owner = 1 AND created > 3')
+
+    try:
+        New(IndexedAccount, email='account3@website.com')
+    except sqlalchemy.exc.IntegrityError:
+        pass
+    else:
+        raise Exception('email should be unique')
+
+    # a unique index that cant be created because of duplicates does not break reads and New()
+    class DuplicateAccount(BaseTable):
+        __uniqueIndexes__ = [('email',)]
+
+    Drop(DuplicateAccount, confirm=True)
+    _dbWorker._db['DuplicateAccount'].insert_many([dict(email='a'), dict(email='a')])
+    assert FindOne(DuplicateAccount, email='a') is not None
+    assert len(list(FindAll(DuplicateAccount, email='a'))) == 2
+    assert New(DuplicateAccount, email='b')['email'] == 'b'
+    try:
+        EnsureIndexes(DuplicateAccount)
+    except sqlalchemy.exc.IntegrityError:
+        pass
+    else:
+        raise Exception('EnsureIndexes() should raise')
+
+
+def test_DisabledLoggingFormatsNothing():
+    from dictabase import SetDebug
+
+    formatted = []
+
+    class QuietClass(BaseTable):
+        def __str__(self):
+            formatted.append(self['id'])
+            return super().__str__()
+
+    SetDebug(False)
+    try:
+        Drop(QuietClass, confirm=True)
+        obj = New(QuietClass, name='a')
+        obj['name'] = 'b'
+        assert FindOne(QuietClass, name='b') is obj
+        assert len(list(FindAll(QuietClass))) == 1
+        del obj
+        Delete(FindOne(QuietClass, name='b'))
+        assert formatted == []
+
+    finally:
+        SetDebug(True)
+
+    FindOne(QuietClass)
+    New(QuietClass, name='c')
+    assert len(formatted) > 0
+
+
+def test_FindAllPagination():
+    from dictabase import NewMany
+
+    class PagedClass(BaseTable):
+        pass
+
+    Drop(PagedClass, confirm=True)
+    NewMany(PagedClass, (dict(count=i) for i in range(100)))
+
+    page = list(FindAll(PagedClass, _orderBy='count', _limit=10, _offset=20))
+    assert [obj['count'] for obj in page] == list(range(20, 30))
+
+    # keyset pagination
+    counts = []
+    after = None
+    while True:
+        page = list(FindAll(PagedClass, _orderBy='count', _limit=30, _after=after))
+        if not page:
+            break
+        counts.extend(obj['count'] for obj in page)
+        after = (page[-1]['count'], page[-1]['id'])
+    assert counts == list(range(100))
+
+    page = list(FindAll(PagedClass, _orderBy='count', _reverse=True, _after=(50, 51), _limit=3))
+    assert [obj['count'] for obj in page] == [49, 48, 47]
+
+    # many rows with the same value, the id decides which come next
+    Drop(PagedClass, confirm=True)
+    NewMany(PagedClass, (dict(value=i % 3 if i % 5 else None) for i in range(13)))
+    for reverse in (False, True):
+        IDs = []
+        after = None
+        while True:
+            page = list(FindAll(PagedClass, _orderBy='value', _reverse=reverse, _limit=2, _after=after))
+            if not page:
+                break
+            IDs.extend(obj['id'] for obj in page)
+            after = (page[-1]['value'], page[-1]['id'])
+        assert sorted(IDs) == list(range(1, 14))
+        assert IDs == [obj['id'] for obj in FindAll(PagedClass, _orderBy='value', _reverse=reverse)]
+
+    for kwargs in (dict(_orderBy='value', _after=1), dict(_orderBy='missing', _after=(1, 1))):
+        try:
+            list(FindAll(PagedClass, **kwargs))  # not unique without the id / no such column
+            raise AssertionError('_after should raise')
+        except ValueError:
+            pass
+
+
+def test_FindAllDetached():
+    from dictabase import NewMany, _dbWorker
+
+    class StreamedClass(BaseTable):
+        pass
+
+    Drop(StreamedClass, confirm=True)
+    NewMany(StreamedClass, (dict(count=i) for i in range(500)))
+
+    inUse = FindOne(StreamedClass, count=7)
+
+    total = 0
+    for obj in FindAll(StreamedClass, _detached=True, _batchSize=50):
+        total += 1
+        if obj['count'] == 7:
+            assert obj is inUse
+    assert total == 500
+    assert list(_dbWorker._inUse[StreamedClass].values()) == [inUse]
+
+    # changes to detached objs are still written
+    for obj in FindAll(StreamedClass, count=8, _detached=True):
+        obj['count'] = 8000
+    assert FindOne(StreamedClass, count=8000) is not None
+
+
+def test_Columns():
+    loaded = []
+
+    class BigBook(BaseTable):
+        def DumpKey(self, key, value):
+            return json.dumps(value) if key == 'pages' else value
+
+        def LoadKey(self, key, dbValue):
+            loaded.append(key)
+            return json.loads(dbValue) if key == 'pages' else dbValue
+
+    from dictabase import NewMany
+
+    Drop(BigBook, confirm=True)
+    NewMany(BigBook, (dict(name='book{}'.format(i), pages=['page'] * 1000) for i in range(5)))
+
+    loaded.clear()
+    books = list(FindAll(BigBook, _columns=['name'], _orderBy='name'))
+    assert [book['name'] for book in books] == ['book{}'.format(i) for i in range(5)]
+    assert all(book['pages'] is None for book in books)
+    assert 'pages' not in loaded
+
+    # changing a partial obj does not overwrite the columns that were not loaded
+    books[2]['name'] = 'renamed'
+    del books
+
+    book = FindOne(BigBook, name='renamed', _columns=['id', 'name'])
+    assert book is not None and 'pages' not in book
+    del book
+
+    book = FindOne(BigBook, name='renamed')
+    assert len(book['pages']) == 1000
+
+    # objs that are already in use are returned complete
+    assert FindOne(BigBook, name='renamed', _columns=['name']) is book
+
+
+def test_LazyLoadKey():
+    from dictabase import NewMany, Flush
+
+    class BlankClassForClearingInUse(BaseTable):
+        pass
+
+    loaded = []
+    dumped = []
+
+    class LazyClass(BaseTable):
+        def DumpKey(self, key, value):
+            dumped.append(key)
+            return json.dumps(value) if key in ('a', 'b') else value
+
+        def LoadKey(self, key, dbValue):
+            loaded.append(key)
+            return json.loads(dbValue) if key in ('a', 'b') else dbValue
+
+    Drop(LazyClass, confirm=True)
+    NewMany(LazyClass, [dict(a=[1], b=[2], name='lazy')])
+
+    loaded.clear()
+    obj = FindOne(LazyClass, name='lazy')
+    dumped.clear()  # the filter value is dumped too
+    assert 'a' not in loaded and 'b' not in loaded
+
+    assert obj['a'] == [1]
+    assert obj['a'] == [1]
+    assert loaded.count('a') == 1
+    assert 'b' not in loaded
+
+    obj['a'].append(11)
+    Flush(LazyClass)
+
+    # only the key that was used is dumped again
+    assert dumped == ['a']
+
+    del obj
+    Drop(BlankClassForClearingInUse, confirm=True)  # Drop() empties the in-use objects
+    obj = FindOne(LazyClass, name='lazy')
+    assert obj._rawKeys >= {'a', 'b'}
+    assert dict(obj) == {'id': obj['id'], 'a': [1, 11], 'b': [2], 'name': 'lazy'}
+    assert obj.get('b') == [2]
+    assert obj == {'id': obj['id'], 'a': [1, 11], 'b': [2], 'name': 'lazy'}
+
+
+def test_DumpKeyCache():
+    from dictabase import Flush
+
+    dumped = []
+
+    class CachedClass(BaseTable):
+        def DumpKey(self, key, value):
+            dumped.append(key)
+            return json.dumps(value) if key in ('items', 'nested') else value
+
+        def LoadKey(self, key, dbValue):
+            return json.loads(dbValue) if key in ('items', 'nested') else dbValue
+
+    class UncachedClass(CachedClass):
+        __dumpCache__ = False
+
+    for cls in (CachedClass, UncachedClass):
+        Drop(cls, confirm=True)
+
+    cached = New(CachedClass, items=[1, 2, 3], nested=[{'a': 1}])
+    uncached = New(UncachedClass, items=[1, 2, 3], nested=[{'a': 1}])
+
+    # nothing has changed, so the cached dumped values are used
+    dumped.clear()
+    Flush()
+    assert dumped.count('items') == 1  # only for the uncached obj
+
+    # changes in place are still found
+    cached['items'].append(4)
+    dumped.clear()
+    Flush()
+    assert dumped.count('items') == 2
+    assert FindOne(CachedClass, id=cached['id']) is cached
+
+    # nested values are not copied, they are dumped every time so changes deep inside are found too
+    cached['nested'][0]['a'] = 2
+    uncached['nested'][0]['a'] = 2
+    dumped.clear()
+    Flush()
+    assert dumped.count('nested') == 2 and dumped.count('items') == 1
+
+    from dictabase import _dbWorker
+    assert json.loads(_dbWorker._db['CachedClass'].find_one(id=cached['id'])['nested']) == [{'a': 2}]
+    assert json.loads(_dbWorker._db['UncachedClass'].find_one(id=uncached['id'])['nested']) == [{'a': 2}]
+
+
+def test_ConcurrentReads():
+    from threading import Thread
+    from dictabase import NewMany
+
+    class SharedClass(BaseTable):
+        pass
+
+    Drop(SharedClass, confirm=True)
+    NewMany(SharedClass, (dict(count=i) for i in range(200)))
+
+    found = []
+    errors = []
+
+    def Reader():
+        try:
+            for _ in range(20):
+                assert len(list(FindAll(SharedClass, _detached=True))) >= 200
+            found.append(FindOne(SharedClass, count=7))
+        except Exception as e:
+            errors.append(e)
+
+    def Writer():
+        try:
+            NewMany(SharedClass, (dict(count=i) for i in range(200, 300)), chunk_size=10)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [Thread(target=Reader) for _ in range(4)] + [Thread(target=Writer)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    # every thread got the same in-use obj
+    assert len(found) == 4 and all(obj is found[0] for obj in found)
+    assert len(list(FindAll(SharedClass))) == 300
+
+
+def test_Aio():
+    import asyncio
+    from dictabase import aio
+
+    class AsyncClass(BaseTable):
+        pass
+
+    async def Main():
+        await aio.Drop(AsyncClass, confirm=True)
+        objs = await aio.NewMany(AsyncClass, (dict(count=i) for i in range(50)), keepInUse=True)
+
+        # same in-use obj as the blocking API
+        found = await aio.FindOne(AsyncClass, count=3)
+        assert found is objs[3] is FindOne(AsyncClass, count=3)
+
+        counts = [obj['count'] async for obj in aio.FindAll(AsyncClass, _orderBy='count', _batchSize=7)]
+        assert counts == list(range(50))
+
+        # stopping early closes the cursor
+        async for obj in aio.FindAll(AsyncClass, _batchSize=5):
+            break
+
+        # many calls at once, run by a bounded number of workers
+        results = await asyncio.gather(*(aio.FindOne(AsyncClass, count=i) for i in range(50)))
+        assert results == objs
+
+        task = asyncio.ensure_future(aio.FindOne(AsyncClass, count=1))
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        # more open FindAll() loops than workers, each awaiting other calls
+        async def Loop():
+            return [(await aio.FindOne(AsyncClass, id=obj['id']))['count'] async for obj in aio.FindAll(AsyncClass)]
+
+        results = await asyncio.wait_for(asyncio.gather(*(Loop() for _ in range(6))), 10)
+        assert all(result == list(range(50)) for result in results)
+
+    asyncio.run(Main())
+
+
+def test_Transaction():
+    from sqlalchemy import event
+    from dictabase import Transaction, Flush, _dbWorker
+
+    class TxClass(BaseTable):
+        pass
+
+    Drop(TxClass, confirm=True)
+    keep = New(TxClass, name='keep', count=0)
+
+    commits = []
+
+    def Listener(conn):
+        commits.append(conn)
+
+    event.listen(_dbWorker._db.engine, 'commit', Listener)
+    try:
+        with Transaction():
+            objs = [New(TxClass, name='new{}'.format(i)) for i in range(10)]
+            keep['count'] = 1
+            assert FindOne(TxClass, name='new3') is objs[3]  # reads in the transaction see its writes
+    finally:
+        event.remove(_dbWorker._db.engine, 'commit', Listener)
+
+    assert len(commits) == 1
+    assert len(list(FindAll(TxClass))) == 11
+
+    # an exception rolls everything back
+    try:
+        with Transaction():
+            lost = New(TxClass, name='lost')
+            keep['count'] = 2
+            raise ZeroDivisionError()
+    except ZeroDivisionError:
+        pass
+
+    assert 'id' not in lost
+    assert FindOne(TxClass, name='lost') is None
+    assert FindOne(TxClass, name='keep')['count'] == 1
+
+    # savepoints
+    with Transaction():
+        New(TxClass, name='outer')
+        try:
+            with Transaction():
+                New(TxClass, name='inner')
+                raise ZeroDivisionError()
+        except ZeroDivisionError:
+            pass
+
+    Flush()
+    assert FindOne(TxClass, name='outer') is not None
+    assert FindOne(TxClass, name='inner') is None
+
+
+def test_TransactionFailedWrite():
+    import sqlalchemy.exc
+    from dictabase import Transaction, EnsureIndexes
+
+    class TxUniqueClass(BaseTable):
+        __uniqueIndexes__ = [('email',)]
+
+    Drop(TxUniqueClass, confirm=True)
+    New(TxUniqueClass, email='a')
+    EnsureIndexes(TxUniqueClass)
+
+    def Emails():
+        return sorted(obj['email'] for obj in FindAll(TxUniqueClass))
+
+    # a failed write inside the block only undoes itself, not the rest of the transaction
+    for fail in (True, False):
+        try:
+            with Transaction():
+                New(TxUniqueClass, email='c')
+                try:
+                    New(TxUniqueClass, email='a')
+                    raise AssertionError('email should be unique')
+                except sqlalchemy.exc.IntegrityError:
+                    pass
+                New(TxUniqueClass, email='d')
+                if fail:
+                    raise ZeroDivisionError()
+        except ZeroDivisionError:
+            pass
+        assert Emails() == (['a'] if fail else ['a', 'c', 'd'])
+
+
+def test_TransactionRollbackKeepsOtherChanges():
+    import threading
+    from dictabase import Transaction, Flush, _dbWorker
+
+    class TxKeptClass(BaseTable):
+        pass
+
+    Drop(TxKeptClass, confirm=True)
+    mine = New(TxKeptClass, x=0)
+    other = New(TxKeptClass, y=0)
+    table = _dbWorker._db['TxKeptClass']
+
+    # a change made before the block is not undone by rolling the block back
+    mine['x'] = 1
+    try:
+        with Transaction():
+            raise ZeroDivisionError()
+    except ZeroDivisionError:
+        pass
+    assert table.find_one(id=mine['id'])['x'] == 1
+    assert FindOne(TxKeptClass, id=mine['id']) is mine
+
+    # neither is a change another thread makes while the block is open
+    try:
+        with Transaction():
+            mine['x'] = 2
+            thread = threading.Thread(target=other.__setitem__, args=('y', 5))
+            thread.start()
+            thread.join()
+            Flush()  # writes both changes inside the transaction
+            raise ZeroDivisionError()
+    except ZeroDivisionError:
+        pass
+    Flush()
+    assert table.find_one(id=mine['id'])['x'] == 1
+    assert table.find_one(id=other['id'])['y'] == 5
+    assert FindOne(TxKeptClass, id=other['id'])['y'] == 5
+
+
+def test_BackgroundFlusher():
+    import gc
+    import threading
+    from sqlalchemy import event
+    from dictabase import NewMany, SetFlushPolicy, FlushStats, SetCacheSize, Flush, _dbWorker
+
+    class FlushedClass(BaseTable):
+        pass
+
+    Drop(FlushedClass, confirm=True)
+    NewMany(FlushedClass, (dict(count=i) for i in range(10)))
+
+    writers = set()
+
+    def Listener(conn, cursor, statement, *a, **k):
+        if statement.startswith('UPDATE'):
+            writers.add(threading.current_thread().name)
+
+    event.listen(_dbWorker._db.engine, 'before_cursor_execute', Listener)
+    inUse = FindOne(FlushedClass, count=2)
+
+    def WaitForFlusher():
+        deadline = time.monotonic() + 5
+        while FlushStats()['pendingRows'] or FlushStats()['releasedObjects'] or FlushStats()['dirtyObjects']:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    SetFlushPolicy(maxAge=0.05, background=True)
+    try:
+        obj = next(FindAll(FlushedClass, count=1, _detached=True))
+        obj['count'] = 100
+        del obj  # only queued, this thread does not write it
+        WaitForFlusher()
+
+        inUse['count'] = 200
+        WaitForFlusher()
+    finally:
+        SetFlushPolicy(maxAge=1, background=False)
+        event.remove(_dbWorker._db.engine, 'before_cursor_execute', Listener)
+
+    assert writers == {'dictabase-flusher'}
+    assert FindOne(FlushedClass, count=100) is not None
+    assert FindOne(FlushedClass, count=200) is inUse
+    assert FlushStats()['flushes'] > 0
+
+    # an obj waiting to be written by the flusher is not found again, the row gets a new obj
+    SetFlushPolicy(background=True)
+    SetCacheSize(0)
+    SetDebug(False)  # the captured log messages would keep a reference to obj
+    try:
+        gc.collect()  # so that del below drops the last reference, not a reference cycle
+        Flush()
+        obj = FindOne(FlushedClass, count=3)
+        ID = obj['id']
+        del obj
+        obj = FindOne(FlushedClass, id=ID)
+        Flush()
+        obj['count'] = 42
+        assert FindOne(FlushedClass, id=ID) is obj
+        obj['count'] = 7
+        del obj
+        Flush()
+    finally:
+        SetDebug(True)
+        SetCacheSize(1000)
+        SetFlushPolicy(background=False)
+    assert _dbWorker._db['FlushedClass'].find_one(id=ID)['count'] == 7
+
+
+def test_WeakInUse():
+    import gc
+    from dictabase import SetCacheSize, CacheStats, _dbWorker
+
+    class CachedClass(BaseTable):
+        def LoadKey(self, key, dbValue):
+            return json.loads(dbValue) if key == 'tags' else dbValue
+
+        def DumpKey(self, key, value):
+            return json.dumps(value) if key == 'tags' else value
+
+    Drop(CachedClass, confirm=True)
+    SetDebug(False)  # the captured log records would keep the objs alive
+    SetCacheSize(2)
+    try:
+        for i in range(5):
+            New(CachedClass, count=i, tags=[i])
+        gc.collect()
+        # only the 2 most recently used objs are still in use
+        assert len(_dbWorker._inUse[CachedClass]) == 2
+
+        before = CacheStats()
+        obj = FindOne(CachedClass, count=4)
+        assert CacheStats()['hits'] == before['hits'] + 1
+
+        # an obj that is evicted while nothing else references it has its changes written first
+        obj['tags'].append('changed')
+        del obj
+        FindOne(CachedClass, count=0)
+        FindOne(CachedClass, count=1)
+        assert CacheStats()['evictions'] > before['evictions']
+        gc.collect()
+        assert FindOne(CachedClass, count=4)['tags'] == [4, 'changed']
+
+        # referenced objs stay in use no matter the cache size
+        SetCacheSize(0)
+        kept = FindOne(CachedClass, count=2)
+        gc.collect()
+        assert FindOne(CachedClass, count=2) is kept
+        assert list(_dbWorker._inUse[CachedClass].values()) == [kept]
+    finally:
+        SetCacheSize(1000)
+        SetDebug(True)
+
+
+def test_DeleteWhereUpdateWhere():
+    from dictabase import NewMany, DeleteWhere, UpdateWhere
+
+    class SessionClass(BaseTable):
+        def LoadKey(self, key, dbValue):
+            return json.loads(dbValue) if key == 'data' else dbValue
+
+        def DumpKey(self, key, value):
+            return json.dumps(value) if key == 'data' else value
+
+    Drop(SessionClass, confirm=True)
+    NewMany(SessionClass, (dict(expires=i, data={'i': i}) for i in range(100)))
+
+    expired = FindOne(SessionClass, expires=5)
+    live = FindOne(SessionClass, expires=50)
+    live['data'] = {'changed': True}  # queued, must be written before the UPDATE
+
+    statements = CountWrites(lambda: DeleteWhere(SessionClass, expires={'lt': 10}))
+    assert len(statements) == 1  # the queued change, the rows are deleted without being loaded or written
+    assert expired._deleted
+    assert FindOne(SessionClass, expires=5) is None
+    assert len(list(FindAll(SessionClass))) == 90
+
+    assert UpdateWhere(SessionClass, {'expires': {'gte': 50}}, {'data': {'renewed': True}}) == 50
+    # the in-use obj got the new value, and the queued change did not overwrite it
+    assert live['data'] == {'renewed': True}
+    assert FindOne(SessionClass, expires=99, _columns=['data'])['data'] == {'renewed': True}
+    assert FindOne(SessionClass, expires=49)['data'] == {'i': 49}
+
+    try:
+        DeleteWhere(SessionClass)
+        raise AssertionError('deleting every row should need confirm=True')
+    except PermissionError:
+        pass
+    assert len(list(FindAll(SessionClass))) == 90
+    assert DeleteWhere(SessionClass, confirm=True) == 90
+    assert FindOne(SessionClass) is None
+
+
+def test_QueryOperators():
+    from dictabase import NewMany
+    from dictabase.query import Matcher
+
+    class OperatorClass(BaseTable):
+        pass
+
+    Drop(OperatorClass, confirm=True)
+    ages = [10, 20, 25, 30, 35, 40, None]
+    names = ['Grant', 'greg', 'Anna', 'a_x', 'b%c', None, 'GRÜN']
+    objs = NewMany(OperatorClass, [dict(age=a, name=n) for a, n in zip(ages, names)], keepInUse=True)
+
+    filters = [
+        dict(age={'gt': 30}),
+        dict(age={'>=': 30, '<': 40}),
+        dict(age=[20, 30, None]),
+        dict(age={'notin': [20, 30]}),
+        dict(age={'between': (25, 35)}),
+        dict(age=None),
+        dict(age={'isnull': False}),
+        dict(age={'ne': 30}),
+        dict(name={'like': 'gr%'}),
+        dict(name={'ilike': 'GR%'}),
+        dict(name={'notlike': '%a%'}),
+        dict(name={'startswith': 'Gr'}),
+        dict(name={'endswith': '_x'}),
+        dict(name={'contains': '%'}),
+        dict(name={'like': '_r%'}, age={'lt': 25}),
+        dict(missing={'isnull': True}),
+        dict(missing=1),
+    ]
+    for f in filters:
+        # the db and the in-memory matcher agree
+        inDB = {obj['id'] for obj in FindAll(OperatorClass, _detached=True, **f)}
+        match = Matcher(f)
+        inMemory = {obj['id'] for obj in objs if match(obj)}
+        print('filters=', f, 'inDB=', inDB, 'inMemory=', inMemory)
+        assert inDB == inMemory
+
+    assert [obj['age'] for obj in FindAll(OperatorClass, age={'gt': 20}, _orderBy='age')] == [25, 30, 35, 40]
+    assert FindOne(OperatorClass, age={'between': (11, 20)}) is objs[1]
+
+    try:
+        FindOne(OperatorClass, age={'bigger': 1})
+        raise AssertionError('unknown operators should raise')
+    except ValueError:
+        pass
+
+
+def test_Aggregates():
+    from dictabase import NewMany, Count, Exists, Sum, Min, Max, CacheStats
+
+    class OrderClass(BaseTable):
+        pass
+
+    class OtherClass(BaseTable):
+        pass
+
+    Drop(OrderClass, confirm=True)
+    Drop(OtherClass, confirm=True)
+    assert Count(OrderClass) == 0
+    assert Exists(OrderClass) is False
+    assert Sum(OrderClass, 'price') is None
+    assert Count(OrderClass, _groupBy='country') == {}
+
+    NewMany(OrderClass, (dict(price=i, country=['NL', 'BE'][i % 2]) for i in range(10)))
+    other = New(OtherClass, a=1)
+
+    order = FindOne(OrderClass, price=9)
+    order['price'] = 100  # queued, must be counted
+    other['a'] = 2  # queued, but cannot change the result
+
+    misses = CacheStats()['misses']
+    statements = CountWrites(lambda: Count(OrderClass, price={'gt': 50}))
+    assert len(statements) == 1 and 'OrderClass' in statements[0]  # OtherClass is not written
+    assert CacheStats()['misses'] == misses  # no objs were created
+
+    assert Count(OrderClass) == 10
+    assert Count(OrderClass, price={'gt': 50}) == 1
+    assert Exists(OrderClass, country='BE', price=100) is True
+    assert Exists(OrderClass, country='NL', price=100) is False
+    assert Sum(OrderClass, 'price') == 136
+    assert Min(OrderClass, 'price', country='BE') == 1
+    assert Max(OrderClass, 'price') == 100
+    assert Count(OrderClass, _groupBy='country') == {'NL': 5, 'BE': 5}
+    assert Sum(OrderClass, 'price', _groupBy='country', price={'lt': 5}) == {'NL': 6, 'BE': 4}
+    assert Max(OrderClass, 'missing') is None
+    assert Count(OrderClass, _groupBy='missing') == {None: 10}
+
+
+def test_QueryCache():
+    from dictabase import NewMany, SetQueryCache, QueryCacheStats, DeleteWhere
+    from sqlalchemy import event
+    from dictabase import _dbWorker
+
+    class CachedClass(BaseTable):
+        pass
+
+    Drop(CachedClass, confirm=True)
+    SetQueryCache(CachedClass, maxEntries=2, maxAge=60)
+    NewMany(CachedClass, (dict(status=['active', 'idle'][i % 2], created=i) for i in range(10)))
+
+    selects = []
+
+    def Listener(conn, cursor, statement, *a, **k):
+        if statement.startswith('SELECT') and 'CachedClass' in statement:
+            selects.append(statement)
+
+    def Active():
+        return [obj['created'] for obj in FindAll(CachedClass, status='active', _orderBy='created')]
+
+    event.listen(_dbWorker._db.engine, 'before_cursor_execute', Listener)
+    try:
+        stats = QueryCacheStats()
+        assert Active() == [0, 2, 4, 6, 8]
+        numSelects = len(selects)
+        assert Active() == [0, 2, 4, 6, 8]
+        assert len(selects) == numSelects  # answered from the cache
+        assert QueryCacheStats()['hits'] == stats['hits'] + 1
+
+        # a change to an in-use obj is written before the next FindAll(), which clears the cache
+        obj = FindOne(CachedClass, created=3)
+        obj['status'] = 'active'
+        assert Active() == [0, 2, 3, 4, 6, 8]
+        assert QueryCacheStats()['invalidations'] > stats['invalidations']
+
+        New(CachedClass, status='active', created=10)
+        assert Active() == [0, 2, 3, 4, 6, 8, 10]
+
+        DeleteWhere(CachedClass, created={'lt': 3})
+        assert Active() == [3, 4, 6, 8, 10]
+
+        # other kwargs are cached separately, the least recently used is dropped
+        list(FindAll(CachedClass, status='idle'))
+        list(FindAll(CachedClass, status='idle', _limit=1))
+        assert QueryCacheStats()['evictions'] == stats['evictions'] + 1
+
+        SetQueryCache(CachedClass, maxEntries=0)
+        numSelects = len(selects)
+        Active()
+        Active()
+        assert len(selects) == numSelects + 2
+    finally:
+        event.remove(_dbWorker._db.engine, 'before_cursor_execute', Listener)
+
+
+def test_SchemaCache():
+    from dictabase import Transaction, Flush
+    from sqlalchemy import event
+    from dictabase import _dbWorker
+
+    class SchemaClass(BaseTable):
+        pass
+
+    Drop(SchemaClass, confirm=True)
+    obj = New(SchemaClass, a=1)
+
+    statements = []
+
+    def Listener(conn, cursor, statement, *a, **k):
+        statements.append(statement)
+
+    event.listen(_dbWorker._db.engine, 'before_cursor_execute', Listener)
+    try:
+        for i in range(5):
+            New(SchemaClass, a=i)
+            obj['a'] = i
+            Flush(SchemaClass)
+        # the columns are not looked up again, only the rows are written
+        print('statements=', statements)
+        assert all(s.startswith(('INSERT', 'UPDATE', 'BEGIN', 'COMMIT')) for s in statements)
+
+        del statements[:]
+        New(SchemaClass, a=1, b='new')
+        assert len([s for s in statements if s.startswith('ALTER')]) == 1
+    finally:
+        event.remove(_dbWorker._db.engine, 'before_cursor_execute', Listener)
+
+    # a rollback also undoes the new column
+    try:
+        with Transaction():
+            New(SchemaClass, c=1)
+            raise KeyError
+    except KeyError:
+        pass
+
+    New(SchemaClass, c=2)
+    assert FindOne(SchemaClass, c=2)['c'] == 2
+    assert FindOne(SchemaClass, b='new')['a'] == 1
+
+
+def test_Stats():
+    import logging
+    import dictabase
+    from dictabase import SetMetrics, Stats, ResetStats, AddSQLHook, RemoveSQLHook, Flush
+    from dictabase.metrics import metrics
+
+    class MetricsClass(BaseTable):
+        def LoadKey(self, key, dbValue):
+            return json.loads(dbValue) if key == 'data' else dbValue
+
+        def DumpKey(self, key, value):
+            return json.dumps(value) if key == 'data' else value
+
+    Drop(MetricsClass, confirm=True)
+    assert not metrics._listening  # nothing is listening to the db while metrics are off
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            slow.append(record.getMessage())
+
+    slow = []
+    handler = Handler()
+    logging.getLogger('dictabase.slow').addHandler(handler)
+
+    hooked = []
+
+    def Hook(statement, parameters, seconds, operation):
+        hooked.append(operation)
+
+    SetMetrics(True, slowSeconds=0)
+    ResetStats()
+    AddSQLHook(Hook)
+    try:
+        obj = New(MetricsClass, data=[1])
+        obj['data'].append(2)
+        Flush(MetricsClass)
+        assert FindOne(MetricsClass, id=obj['id']) is obj
+        assert len(list(FindAll(MetricsClass))) == 1
+        dictabase.NewMany(MetricsClass, [dict(data=[4])])
+        assert FindOne(MetricsClass, id=obj['id'] + 1)['data'] == [4]
+        obj = None
+
+        stats = Stats()
+        print('stats=', stats)
+        operations = stats['operations']
+        assert operations['New']['count'] == 1
+        assert operations['New']['statements'] >= 1
+        assert operations['FindAll']['count'] == 1 and operations['FindAll']['statements'] >= 1
+        assert operations['FindOne']['count'] == 2
+        assert operations['FindOne']['statements'] == 1  # the first one was found in use
+        assert sum(operations['FindOne']['histogram'].values()) == 2
+        assert stats['tables']['MetricsClass']['Flush']['count'] == 1
+        assert stats['counters']['upsertsFromFlush'] >= 1
+        assert stats['dumpKey']['MetricsClass']['calls'] >= 3  # New(), the change and NewMany()
+        assert stats['loadKey']['MetricsClass']['calls'] == 1
+        assert stats['sql']['statements'] == len(hooked)
+        assert 'New' in hooked and 'FindAll' in hooked
+        assert any(message.startswith('slow FindAll(MetricsClass)') for message in slow)
+        assert 'cache' in stats and 'flush' in stats and 'queryCache' in stats
+    finally:
+        RemoveSQLHook(Hook)
+        SetMetrics(False)
+        logging.getLogger('dictabase.slow').removeHandler(handler)
+
+    assert not metrics._listening
+    New(MetricsClass, data=[3])
+    assert Stats()['operations']['New']['count'] == 1
+
+
+def test_Sharding():
+    import os
+    import tempfile
+    import dictabase
+    from dictabase import Route, Shard, NewMany, Count, Sum, Transaction, Flush
+
+    class RoutedClass(BaseTable):
+        pass
+
+    class ShardedClass(BaseTable):
+        pass
+
+    tempDir = tempfile.mkdtemp()
+    routedURI = 'sqlite:///' + os.path.join(tempDir, 'routed.db')
+    shardURIs = ['sqlite:///' + os.path.join(tempDir, 'shard{}.db'.format(i)) for i in range(3)]
+
+    Route(RoutedClass, routedURI)
+    routed = New(RoutedClass, name='a')
+    routed['name'] = 'b'
+    Flush(RoutedClass)
+    routedWorker = dictabase._router.Workers(RoutedClass)[0]
+    assert routed._worker is routedWorker
+    assert routedWorker._db['RoutedClass'].find_one(id=routed['id'])['name'] == 'b'
+    assert 'RoutedClass' not in dictabase._dbWorker._db.tables
+    assert FindOne(RoutedClass, name='b') is routed
+
+    Shard(ShardedClass, 'user', shardURIs)
+    try:
+        New(ShardedClass, value=1)
+        assert False, 'a sharded row needs its shard key'
+    except ValueError:
+        pass
+
+    ids = NewMany(ShardedClass, (dict(user=i % 10, value=i) for i in range(100)), chunk_size=30)
+    assert len(ids) == 100
+    counts = [worker._db['ShardedClass'].count() for worker in dictabase._router.Workers(ShardedClass)]
+    assert sum(counts) == 100 and all(counts)  # every shard got some rows
+
+    assert Count(ShardedClass) == 100
+    assert Count(ShardedClass, user=3) == 10
+    assert Count(ShardedClass, _groupBy='user') == {user: 10 for user in range(10)}
+    assert Sum(ShardedClass, 'value') == sum(range(100))
+    assert dictabase.Max(ShardedClass, 'value', user={'in': [1, 2]}) == 92
+
+    found = list(FindAll(ShardedClass, _orderBy='value'))
+    assert [obj['value'] for obj in found] == list(range(100))
+    found = list(FindAll(ShardedClass, _orderBy='value', _reverse=True, _limit=5, _offset=2))
+    assert [obj['value'] for obj in found] == [97, 96, 95, 94, 93]
+    assert sorted(obj['value'] for obj in FindAll(ShardedClass, user=4)) == list(range(4, 100, 10))
+
+    obj = FindOne(ShardedClass, user=7, value=57)
+    obj['value'] = 1057
+    Flush()
+    assert FindOne(ShardedClass, value=1057) is obj
+    assert dictabase.UpdateWhere(ShardedClass, {'value': {'lt': 10}}, {'small': True}) == 10
+    assert dictabase.DeleteWhere(ShardedClass, small=True) == 10
+    Delete(obj)
+    assert Count(ShardedClass) == 89
+    assert not dictabase.Exists(ShardedClass, value=1057)
+
+    try:
+        with Transaction():
+            New(ShardedClass, user=1, value=-1)
+            New(RoutedClass, name='c')
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert not dictabase.Exists(ShardedClass, value=-1)
+    assert not dictabase.Exists(RoutedClass, name='c')
+
+    # inside a transaction the shards are searched on this thread, which holds their write locks
+    changed = FindOne(ShardedClass, value=50)
+    with Transaction():
+        changed['value'] = -50
+        NewMany(ShardedClass, (dict(user=i, value=-i) for i in range(1, 4)))
+        assert len(list(FindAll(ShardedClass, value={'lt': 0}))) == 4  # writes the change first
+        assert Count(ShardedClass, value={'lt': 0}) == 4
+        assert len(list(FindAll(ShardedClass, value={'lt': 0}, _detached=True, _limit=10))) == 4
+
+    from dictabase.router import ShardIndex
+    assert ShardIndex(1, 7) == ShardIndex(1.0, 7) == ShardIndex(True, 7)
+
+    Drop(ShardedClass, confirm=True)
+    assert Count(ShardedClass) == 0
+
+
+def test_FindAllColumns():
+    import dictabase
+    from dictabase import NewMany, FindAllColumns
+
+    class ColumnsClass(BaseTable):
+        def LoadKey(self, key, dbValue):
+            return {
+                'tags': lambda v: json.loads(v),
+            }.get(key, lambda v: v)(dbValue)
+
+        def DumpKey(self, key, value):
+            return {
+                'tags': lambda v: json.dumps(v),
+            }.get(key, lambda v: v)(value)
+
+    Drop(ColumnsClass, confirm=True)
+    NewMany(ColumnsClass, (dict(price=i / 2, volume=i, tags=[i]) for i in range(100)))
+    obj = FindOne(ColumnsClass, volume=99)
+    obj['price'] = 1000.0  # not written yet, FindAllColumns() writes it first
+
+    worker = dictabase._router.Workers(ColumnsClass)[0]
+    batches = list(worker.FindColumns(ColumnsClass, ['volume', 'tags', 'missing'], {'volume': {'gte': 90}}, batchSize=4))
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert batches[0][0] == (90, [90], None)  # LoadKey() was called
+
+    batches = list(worker.FindColumns(ColumnsClass, ['price'], {}, orderBy='price', reverse=True, limit=2))
+    assert batches == [[(1000.0,), (49.0,)]]
+
+    numpy = pytest.importorskip('numpy')  # the checks above dont need numpy
+
+    arrays = FindAllColumns(ColumnsClass, ['price', 'volume'], _dtypes={'price': 'f8'}, _batchSize=30)
+    assert arrays['price'].dtype == numpy.float64 and len(arrays['price']) == 100
+    assert arrays['price'][-1] == 1000.0
+    assert arrays['volume'].sum() == sum(range(100))
+
+    structured = FindAllColumns(ColumnsClass, ['volume', 'price'], _structured=True, volume={'lt': 3})
+    assert list(structured['volume']) == [0, 1, 2]
+    assert len(FindAllColumns(ColumnsClass, ['price'], volume=-1)['price']) == 0
+
+
+def test_FindAllReadonly():
+    import sys
+    import dictabase
+    from dictabase import NewMany
+
+    class ReadonlyClass(BaseTable):
+        def LoadKey(self, key, dbValue):
+            return {
+                'tags': lambda v: json.loads(v),
+            }.get(key, lambda v: v)(dbValue)
+
+        def DumpKey(self, key, value):
+            return {
+                'tags': lambda v: json.dumps(v),
+            }.get(key, lambda v: v)(value)
+
+    Drop(ReadonlyClass, confirm=True)
+    NewMany(ReadonlyClass, (dict(name='name{}'.format(i), count=i, tags=[i]) for i in range(50)))
+    inUse = FindOne(ReadonlyClass, count=3)
+    inUse['name'] = 'changed'  # not written yet, FindAll() writes it first
+
+    rows = list(FindAll(ReadonlyClass, _readonly=True, _orderBy='count', _batchSize=7))
+    assert len(rows) == 50
+    row = rows[3]
+    assert row['name'] == 'changed' and row.name == 'changed'
+    assert row['tags'] == [3]  # LoadKey() was called
+    assert row['missing'] is None and row.get('missing', 1) == 1 and 'missing' not in row
+    assert dict(row.items()) == dict(inUse) and row == dict(inUse)
+    assert rows[0]._layout is rows[49]._layout  # one layout per query
+    assert len(dictabase._dbWorker._inUse[ReadonlyClass]) == 1  # only inUse
+
+    for change in (lambda: row.__setitem__('name', 'x'), lambda: setattr(row, 'name', 'x')):
+        try:
+            change()
+            assert False, 'rows are read-only'
+        except TypeError:
+            pass
+    try:
+        row.missing
+        assert False, 'unknown attributes raise AttributeError'
+    except AttributeError:
+        pass
+
+    rows = list(FindAll(ReadonlyClass, _readonly=True, _columns=['count'], count={'gte': 48}))
+    assert [list(row.keys()) for row in rows] == [['id', 'count']] * 2
+    assert not hasattr(row, '__dict__') and not hasattr(row, '__del__')
+
+    # compact, the values are in one tuple and the keys are shared
+    obj = FindOne(ReadonlyClass, count=10)
+    assert sys.getsizeof(row) + sys.getsizeof(row._values) < sys.getsizeof(obj)
+
+
+class PickledClass(BaseTable):
+    pass
+
+
+def test_Pickle():
+    import pickle
+
+    obj = New(PickledClass, name='a', count=1)
+    obj.note = 'kept'
+    copy = pickle.loads(pickle.dumps(obj))
+    assert copy == obj and copy is not obj
+    assert copy.note == 'kept' and copy._worker is None and not copy._dirtyKeys
+    copy['name'] = 'b'  # not in use, never written
+    assert FindOne(PickledClass, id=obj['id'])['name'] == 'a'
+
+
+def test_UnwritableRowIsDropped():
+    from dictabase import _dbWorker, Flush, FlushStats, SetFlushPolicy, EnsureIndexes, Transaction
+
+    class UniqueEmail(BaseTable):
+        __uniqueIndexes__ = [('email',)]
+
+    class OtherClass(BaseTable):
+        pass
+
+    Drop(UniqueEmail, confirm=True)
+    Drop(OtherClass, confirm=True)
+    New(UniqueEmail, email='a')
+    b = New(UniqueEmail, email='b')
+    c = New(UniqueEmail, email='c')
+    other = New(OtherClass, x=1)
+    EnsureIndexes(UniqueEmail)
+
+    b['email'] = 'a'  # can never be written
+    c['email'] = 'd'
+    other['x'] = 2
+    Flush()  # logs and drops the change to b instead of raising
+    Flush()
+
+    table = _dbWorker._db['UniqueEmail']
+    assert [row['email'] for row in table.find(order_by='id')] == ['a', 'b', 'd']
+    assert _dbWorker._db['OtherClass'].find_one(id=other['id'])['x'] == 2
+    assert FlushStats()['pendingRows'] == 0
+    # the obj with the dropped change is loaded from the db again
+    assert FindOne(UniqueEmail, email='b') is not b
+    assert FindOne(UniqueEmail, email='b')['email'] == 'b'
+    assert len(list(FindAll(UniqueEmail, email='a'))) == 1
+
+    # inside Transaction() the unwritable row does not undo the rest of the transaction
+    with Transaction():
+        e = New(UniqueEmail, email='e')
+        c['email'] = 'a'
+        other['x'] = 4
+        Flush()
+        New(UniqueEmail, email='f')
+    assert [row['email'] for row in table.find(order_by='id')] == ['a', 'b', 'd', 'e', 'f']
+    assert _dbWorker._db['OtherClass'].find_one(id=other['id'])['x'] == 4
+    assert 'id' in e
+
+    # a lone queued change is written after maxAge, without another change or Flush()
+    SetFlushPolicy(maxAge=0.2)
+    try:
+        _dbWorker.Upsert(other, keepInUse=True)  # nothing changed, nothing queued
+        other['x'] = 3
+        _dbWorker.Upsert(other, keepInUse=True)  # queues the change
+        assert FlushStats()['pendingRows'] == 1
+        time.sleep(0.6)
+        assert _dbWorker._db['OtherClass'].find_one(id=other['id'])['x'] == 3
+        assert FlushStats()['pendingRows'] == 0
+    finally:
+        SetFlushPolicy(maxAge=1)
+
+
+def test_CachedChangesWrittenAfterMaxAge():
+    from dictabase import _dbWorker, SetFlushPolicy, NewMany
+
+    class AgedClass(BaseTable):
+        def LoadKey(self, key, dbValue):
+            return {
+                'tags': lambda v: json.loads(v),
+            }.get(key, lambda v: v)(dbValue)
+
+        def DumpKey(self, key, value):
+            return {
+                'tags': lambda v: json.dumps(v),
+            }.get(key, lambda v: v)(value)
+
+    Drop(AgedClass, confirm=True)
+    SetFlushPolicy(maxAge=0.2)
+    try:
+        a = New(AgedClass, x=1, tags=[1])
+        ID = a['id']
+        a['x'] = 2
+        del a  # the cache still holds it, so __del__() is not called
+        time.sleep(0.6)
+        assert _dbWorker._db['AgedClass'].find_one(id=ID)['x'] == 2
+
+        FindOne(AgedClass, id=ID)['tags'].append(2)  # changed in place, then dropped
+        time.sleep(0.6)
+        assert json.loads(_dbWorker._db['AgedClass'].find_one(id=ID)['tags']) == [1, 2]
+
+        # idle objs with mutable values are not dumped again every maxAge
+        dumps = []
+
+        class WatchedClass(AgedClass):
+            def DumpKey(self, key, value):
+                if key == 'tags':
+                    dumps.append(value)
+                return super().DumpKey(key, value)
+
+        Drop(WatchedClass, confirm=True)
+        NewMany(WatchedClass, (dict(tags=[{'i': i}]) for i in range(20)))  # a list of dicts is dumped every check
+        objs = list(FindAll(WatchedClass))
+        assert all(obj['tags'] for obj in objs)  # loaded, so they can be changed in place
+        time.sleep(0.5)
+        del dumps[:]
+        time.sleep(0.6)
+        assert len(dumps) == 0
+        assert len(objs) == 20
+    finally:
+        SetFlushPolicy(maxAge=1)
+
+
+def test_IndexesDontBlockReads():
+    import threading
+    import sqlalchemy.exc
+    from dictabase import _dbWorker, Transaction, EnsureIndexes
+
+    class SoftDeleted(BaseTable):
+        __indexes__ = [('deletedAt',)]  # the column does not exist yet
+
+    Drop(SoftDeleted, confirm=True)
+    New(SoftDeleted, name='a')
+
+    inTransaction = threading.Event()
+    done = threading.Event()
+
+    def Writer():
+        with Transaction():
+            inTransaction.set()
+            done.wait(5)
+
+    thread = threading.Thread(target=Writer)
+    thread.start()
+    try:
+        inTransaction.wait(5)
+        start = time.perf_counter()
+        assert FindOne(SoftDeleted, name='a')['name'] == 'a'
+        assert time.perf_counter() - start < 0.5  # did not wait for the transaction
+    finally:
+        done.set()
+        thread.join()
+
+    # a unique index is created even if a normal index on the same columns exists
+    class UniqueLater(BaseTable):
+        __uniqueIndexes__ = [('code',)]
+
+    Drop(UniqueLater, confirm=True)
+    table = _dbWorker._db['UniqueLater']
+    table.insert(dict(code='a'))
+    table.create_index(['code'])
+    EnsureIndexes(UniqueLater)
+    try:
+        New(UniqueLater, code='a')
+    except sqlalchemy.exc.IntegrityError:
+        pass
+    else:
+        raise Exception('code should be unique')